@@ -1,18 +1,69 @@
+import argparse
+import csv
+import glob
+import hashlib
+import io
 import json
-import matplotlib.pyplot as plt
+import math
+from bisect import bisect_right
 from datetime import datetime, date
-from dateutil.relativedelta import relativedelta
-from collections import defaultdict
-import tiktoken
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing, contextmanager, redirect_stdout
+from itertools import islice
+from statistics import NormalDist
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import numpy as np
+# matplotlib, tiktoken and dateutil are slow to import, and tomllib needs Python 3.11, so they are only
+# imported by the code that uses them
 
 # Global variables for cost calculation
+# Prices are in USD per million tokens; "cached" is the price of input tokens read from the prompt cache
+# (the input price when missing, as for models without a prompt cache discount),
+# "image" and "audio" the prices of image and audio tokens read by the model (the input price when missing),
+# "image_output" and "audio_output" those of generated image and audio tokens (the output price when missing), and
+# "reasoning" the price of hidden reasoning tokens (the output price when missing).
+# Reasoning models also have a "reasoning_multiplier", the estimated reasoning tokens per visible
+# output token used when an export records no reasoning, and models unknown to tiktoken an "encoding".
 COSTS = {
-    "gpt-4": {"input": 30.0, "output": 60.0},
-    "gpt-4-turbo": {"input": 10.0, "output": 30.0},
-    "gpt-4o": {"input": 5.0, "output": 15.0},
-    "gpt-3.5-turbo": {"input": 0.5, "output": 1.5}
+    "gpt-4": {"input": 30.0, "cached": 30.0, "output": 60.0, "context_window": 8_192},
+    "gpt-4-turbo": {"input": 10.0, "cached": 10.0, "output": 30.0, "image": 10.0, "context_window": 128_000},
+    "gpt-4o": {"input": 5.0, "cached": 5.0, "output": 15.0, "image": 5.0, "audio": 100.0,
+               "audio_output": 200.0, "context_window": 128_000},
+    "gpt-4o-mini": {"input": 0.15, "cached": 0.075, "output": 0.6, "image": 5.0, "context_window": 128_000},
+    "gpt-3.5-turbo": {"input": 0.5, "cached": 0.5, "output": 1.5, "context_window": 16_385},
+    "o1": {"input": 15.0, "cached": 7.5, "output": 60.0, "context_window": 200_000,
+           "reasoning_multiplier": 4.0, "encoding": "o200k_base"},
+    "o1-pro": {"input": 150.0, "output": 600.0, "context_window": 200_000,
+               "reasoning_multiplier": 4.0, "encoding": "o200k_base"},
+    "o1-mini": {"input": 1.1, "cached": 0.55, "output": 4.4, "context_window": 128_000,
+                "reasoning_multiplier": 3.0, "encoding": "o200k_base"},
+    "o3-pro": {"input": 20.0, "output": 80.0, "context_window": 200_000,
+               "reasoning_multiplier": 3.0, "encoding": "o200k_base"},
+    "o3-mini": {"input": 1.1, "cached": 0.55, "output": 4.4, "context_window": 200_000,
+                "reasoning_multiplier": 3.0, "encoding": "o200k_base"},
+    "o3": {"input": 2.0, "cached": 0.5, "output": 8.0, "context_window": 200_000,
+           "reasoning_multiplier": 3.0, "encoding": "o200k_base"},
+    "o4-mini": {"input": 1.1, "cached": 0.275, "output": 4.4, "context_window": 200_000,
+                "reasoning_multiplier": 3.0, "encoding": "o200k_base"}
 }
 
+# Context window assumed for models without a "context_window" entry in COSTS
+DEFAULT_CONTEXT_WINDOW = 128_000
+
+# Prompt caching: seconds a prompt prefix stays cached, minimum cached prefix and cache granularity
+PROMPT_CACHE_TTL = 300
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_INCREMENT = 128
+
 MODEL_MAPPINGS = {
     "gpt-4": "gpt-4-turbo",
     "gpt-4-browsing": "gpt-4-turbo",
@@ -22,106 +73,1468 @@ MODEL_MAPPINGS = {
     "gpt-4-mobile": "gpt-4-turbo",
     "gpt-4-plugins": "gpt-4-turbo",
     "gpt-4o": "gpt-4o",
+    "gpt-4o-mini": "gpt-4o-mini",
     "text-davinci-002-render": "gpt-3.5-turbo",
     "text-davinci-002-render-sha": "gpt-3.5-turbo",
-    "text-davinci-002-render-sha-mobile": "gpt-3.5-turbo"
+    "text-davinci-002-render-sha-mobile": "gpt-3.5-turbo",
+    "o1": "o1",
+    "o1-preview": "o1",
+    "o1-pro": "o1-pro",
+    "o1-mini": "o1-mini",
+    "o3": "o3",
+    "o3-pro": "o3-pro",
+    "o3-mini": "o3-mini",
+    "o3-mini-high": "o3-mini",
+    "o4-mini": "o4-mini",
+    "o4-mini-high": "o4-mini"
+}
+
+# Price history per model with effective dates next to this script, used instead of COSTS' prices when present
+PRICE_BOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prices.json')
+
+# Monthly fee in USD of each ChatGPT subscription tier (Team is billed per user)
+SUBSCRIPTION_TIERS = {
+    "Plus": 20.0,
+    "Team": 30.0,
+    "Pro": 200.0
 }
 
+# What-if pricing scenarios next to this script, compared against the actual usage when the file exists
+SCENARIOS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scenarios.json')
+
+# Suffixes of model variants priced differently from their base model, which unknown slugs are never resolved to
+MODEL_VARIANT_SUFFIXES = ("pro", "mini")
+
+# Model used for slugs missing from MODEL_MAPPINGS that do not extend one of its slugs either
+DEFAULT_MODEL = "gpt-4o"
+
+# Local directory caching tiktoken's BPE files, so encodings load without network once present.
+# .tiktoken files placed in BUNDLED_BPE_DIR (e.g. bpe/cl100k_base.tiktoken) are copied into it on first use.
+BPE_CACHE_DIR = os.environ.get('TIKTOKEN_CACHE_DIR', 'bpe_cache')
+BUNDLED_BPE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bpe')
+BPE_BLOB_URL = "https://openaipublic.blob.core.windows.net/encodings"
+
+# Roles of the messages sent to the model as context. Tool messages hold the output of code
+# execution, browsing and other tools, which the model reads back on the next turn.
+CONTEXT_ROLES = ("system", "user", "assistant", "tool")
+
+# Token types tracked per month and model, in the order of the last UsageMatrix axis.
+# Tokens of image and audio parts are tracked in their own modality columns, separately for the
+# media the model reads and the media it generates ("<media>_output"). The unpriced
+# "<role>_context" columns break the context tokens (input, cached and media) down by the role
+# of the message they come from.
+MEDIA_TYPES = ("image", "audio")
+OUTPUT_MEDIA_TYPES = tuple(f"{media_type}_output" for media_type in MEDIA_TYPES)
+ROLE_TYPES = tuple(f"{role}_context" for role in CONTEXT_ROLES)
+TOKEN_TYPES = ("input", "output", "cached", "reasoning") + MEDIA_TYPES + OUTPUT_MEDIA_TYPES + ROLE_TYPES
+TOKEN_TYPE_INDEX = {token_type: i for i, token_type in enumerate(TOKEN_TYPES)}
+
+# Image tokens: images are scaled to fit IMAGE_MAX_SIDE, then their short side to IMAGE_SHORT_SIDE,
+# and cost IMAGE_BASE_TOKENS plus IMAGE_TILE_TOKENS per IMAGE_TILE_SIZE square tile they cover
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+IMAGE_MAX_SIDE = 2048
+IMAGE_SHORT_SIDE = 768
+
+# Audio tokens per second of audio
+AUDIO_TOKENS_PER_SECOND = 10
+
+# Number of characters read at a time when streaming conversations.json
+STREAM_CHUNK_SIZE = 1 << 20
+
+# Number of conversations handed to a worker process at a time
+SHARD_SIZE = 64
+
+# Texts passed to a single tiktoken batch call, and the threads it may use
+TOKENIZE_BATCH_SIZE = 512
+TOKENIZE_THREADS = 4
+
+# How tokens are counted: "exact" tokenizes every part with tiktoken, "approx" estimates counts
+# from text sizes with a bytes-per-token ratio calibrated on a sample of the data, and "sample"
+# tokenizes a random sample of conversations and extrapolates costs with confidence intervals
+TOKENIZER_MODE = "exact"
+CALIBRATION_SAMPLE_SIZE = 2000
+# Leading conversations of an export read to calibrate the estimator, and the file it is kept in between runs
+CALIBRATION_CONVERSATIONS = 1000
+ESTIMATOR_PATH = 'token_estimator.json'
+DEFAULT_BYTES_PER_TOKEN = {"cl100k_base": 4.0, "o200k_base": 4.2}
+DEFAULT_BYTES_PER_TOKEN_FALLBACK = 4.0
+
+# Sampling mode: fraction of conversations tokenized and seed of the random sample
+SAMPLE_FRACTION = 0.05
+SAMPLE_SEED = 0
+
+# On-disk token count cache shared between runs, and the number of entries it may hold
+TOKEN_CACHE_PATH = 'token_cache.sqlite'
+TOKEN_CACHE_MAX_ENTRIES = 2_000_000
+
+# Per-conversation usage kept between runs by the incremental mode, separately for the approx mode
+USAGE_STATE_PATH = 'usage_state.json'
+APPROX_USAGE_STATE_PATH = 'usage_state_approx.json'
+USAGE_STATE_VERSION = 11
+
+# Worker processes used to count tokens; 1 keeps extraction in the main process
+EXTRACTION_WORKERS = os.cpu_count() or 1
+
+# Number of exports processed at the same time when several are given
+BATCH_WORKERS = os.cpu_count() or 1
+
+# Export read when none is given on the command line, and the usage file written by analyze
+DEFAULT_EXPORT_PATH = 'conversation/conversations.json'
+USAGE_PATH = 'usage.json'
+
+def _bpe_cache_key(encoding_name):
+    """Name under which tiktoken caches the BPE file of an encoding."""
+    return hashlib.sha1(f"{BPE_BLOB_URL}/{encoding_name}.tiktoken".encode()).hexdigest()
+
+def seed_bpe_cache(bpe_path, encoding_name=None, cache_dir=BPE_CACHE_DIR):
+    """Copy a local .tiktoken BPE file into the cache so the encoding loads without network.
+
+    The encoding name defaults to the file name, e.g. cl100k_base.tiktoken.
+    """
+    if encoding_name is None:
+        encoding_name = os.path.splitext(os.path.basename(bpe_path))[0]
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, _bpe_cache_key(encoding_name))
+    shutil.copyfile(bpe_path, f"{cache_path}.tmp")
+    os.replace(f"{cache_path}.tmp", cache_path)
+    return cache_path
+
+class TokenizerRegistry:
+    """Tokenizers keyed by encoding name, with model slugs resolved to their model and encoding once.
+
+    Encodings are loaded on first use only, from cache_dir, which is seeded from the .tiktoken
+    files in BUNDLED_BPE_DIR when present; a download is only attempted for encodings found in
+    neither. Models sharing an encoding share a single tokenizer, so each BPE table is loaded
+    only once per process. Unknown slugs resolve to the model of the longest slug they extend
+    (so "o3-2025-04-16" resolves like "o3"), or to DEFAULT_MODEL if there is none. A "-pro" or
+    "-mini" variant never extends its base model, since they are priced very differently.
+    """
+
+    def __init__(self, model_mappings=MODEL_MAPPINGS, default_model=DEFAULT_MODEL, cache_dir=BPE_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.encodings = {}
+        encoding_names = {}
+        import tiktoken
+        for model in {default_model, *model_mappings.values()}:
+            try:
+                encoding_names[model] = COSTS.get(model, {}).get('encoding') or tiktoken.encoding_name_for_model(model)
+            except KeyError as e:
+                print(f"Error resolving the encoding of model {model}: {e}")
+        self._default = (default_model, encoding_names[default_model])
+        self._by_slug = {
+            slug: (model, encoding_names[model]) if model in encoding_names else self._default
+            for slug, model in model_mappings.items()
+        }
+
+    def get(self, encoding_name):
+        """Return the tokenizer of an encoding, loading it on first use."""
+        tokenizer = self.encodings.get(encoding_name)
+        if tokenizer is None:
+            import tiktoken
+            os.environ['TIKTOKEN_CACHE_DIR'] = self.cache_dir
+            bundled_path = os.path.join(BUNDLED_BPE_DIR, f"{encoding_name}.tiktoken")
+            if os.path.exists(bundled_path) and not os.path.exists(os.path.join(self.cache_dir, _bpe_cache_key(encoding_name))):
+                seed_bpe_cache(bundled_path, encoding_name, self.cache_dir)
+            try:
+                tokenizer = tiktoken.get_encoding(encoding_name)
+            except Exception as e:
+                raise RuntimeError(
+                    f"Could not load the {encoding_name} encoding from {self.cache_dir} or the network: {e}. "
+                    f"On hosts without network access, copy {encoding_name}.tiktoken into {BUNDLED_BPE_DIR}/ "
+                    f"or seed the cache with seed_bpe_cache().") from e
+            self.encodings[encoding_name] = tokenizer
+        return tokenizer
+
+    def resolve(self, model_slug):
+        """Return the (model, encoding name) pair used to bill and count a message of the given slug."""
+        resolved = self._by_slug.get(model_slug)
+        if resolved is None:
+            prefixes = [slug for slug in self._by_slug if model_slug and model_slug.startswith(f"{slug}-")
+                        and model_slug[len(slug) + 1:].split('-')[0] not in MODEL_VARIANT_SUFFIXES]
+            resolved = self._by_slug[max(prefixes, key=len)] if prefixes else self._default
+            if model_slug is not None:
+                self._by_slug[model_slug] = resolved
+        return resolved
+
 def load_tokenizers():
     """Load tokenizers for all models."""
-    tokenizers = {}
-    for model in set(MODEL_MAPPINGS.values()):
-        try:
-            tokenizers[model] = tiktoken.encoding_for_model(model)
-        except Exception as e:
-            print(f"Error loading tokenizer for model {model}: {e}")
-    return tokenizers
+    return TokenizerRegistry()
 
 def count_tokens(text, tokenizer):
     """Count the number of tokens in a given text using the preloaded tokenizer."""
     try:
-        return len(tokenizer.encode(text))
+        return len(tokenizer.encode_ordinary(text))
     except Exception as e:
         print(f"Error tokenizing text: {e}")
         return 0
 
-def read_conversation_json(file_path):
-    """Read and parse the JSON file containing the conversation data. And returns a dict"""
+def count_tokens_batch(texts, tokenizer, batch_size=TOKENIZE_BATCH_SIZE, num_threads=TOKENIZE_THREADS):
+    """Count the tokens of many texts with the tokenizer's batch API, keeping only the lengths."""
+    token_counts = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        try:
+            token_counts.extend(len(tokens) for tokens in tokenizer.encode_ordinary_batch(batch, num_threads=num_threads))
+        except Exception as e:
+            print(f"Error tokenizing batch, falling back to single texts: {e}")
+            token_counts.extend(count_tokens(text, tokenizer) for text in batch)
+    return token_counts
+
+class ApproximateTokenCounter:
+    """Estimates token counts from UTF-8 sizes with a bytes-per-token ratio per encoding.
+
+    The ratios default to DEFAULT_BYTES_PER_TOKEN and are normally fitted on a sample of the
+    user's own data with calibrate_estimator, which also records error bounds per encoding.
+    """
+
+    def __init__(self, ratios=None, error_bounds=None):
+        self.ratios = {**DEFAULT_BYTES_PER_TOKEN, **(ratios or {})}
+        self.error_bounds = error_bounds or {}
+
+    def count(self, texts, encoding_name):
+        """Estimate the number of tokens of each text."""
+        bytes_per_token = self.ratios.get(encoding_name, DEFAULT_BYTES_PER_TOKEN_FALLBACK)
+        return [int(len(text.encode('utf-8', 'surrogatepass')) / bytes_per_token + 0.5) for text in texts]
+
+    def to_dict(self):
+        """Convert the calibration to plain JSON-serializable data."""
+        return {'ratios': self.ratios, 'error_bounds': self.error_bounds}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild an estimator from the output of to_dict."""
+        return cls(data['ratios'], data.get('error_bounds'))
+
+    def save(self, path):
+        """Write the calibration to a JSON file."""
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """Read a calibration written by save."""
+        with open(path, 'r') as file:
+            return cls.from_dict(json.load(file))
+
+    def model_error_bounds(self, models):
+        """Map each model to the [part, total] relative error bounds of its encoding, None where uncalibrated."""
+        tokenizers = load_tokenizers()
+        return {model: [self.error_bounds.get(tokenizers.resolve(model)[1], {}).get(bound) for bound in ('part', 'total')]
+                for model in models}
+
+    def print_error_bounds(self):
+        """Print the error bounds recorded by the calibration for each encoding."""
+        print("Token counts are estimated from text sizes, with relative errors of:")
+        for encoding_name, bounds in self.error_bounds.items():
+            print(f"{encoding_name}: mean error per part {bounds['part']:.1%}, "
+                  f"on totals +/-{bounds['total']:.1%} (95%, {bounds['sample_size']} parts)")
+        if not self.error_bounds:
+            print("No error bounds recorded: the estimator was not calibrated on any text.")
+
+def calibrate_estimator(data, tokenizers, sample_size=CALIBRATION_SAMPLE_SIZE, seed=0,
+                        max_conversations=CALIBRATION_CONVERSATIONS):
+    """Fit an ApproximateTokenCounter on a random sample of the message parts of the data.
+
+    Only the first max_conversations conversations are read (all of them if None), and a
+    reservoir sample of sample_size parts is kept per encoding and tokenized exactly. The
+    fitted ratio is total bytes over total tokens; the recorded error bounds are the mean
+    absolute relative error of single parts and the 95% relative error of large totals.
+    """
+    print("Calibrating token estimator...")
+    rng = random.Random(seed)
+    samples = defaultdict(list)
+    seen = defaultdict(int)
+    for conversation in islice(data, max_conversations):
+        for *_, encoding_name, texts, _media in _collect_messages(conversation, tokenizers):
+            for text in texts:
+                seen[encoding_name] += 1
+                if len(samples[encoding_name]) < sample_size:
+                    samples[encoding_name].append(text)
+                else:
+                    slot = rng.randrange(seen[encoding_name])
+                    if slot < sample_size:
+                        samples[encoding_name][slot] = text
+
+    ratios, error_bounds = {}, {}
+    for encoding_name, texts in samples.items():
+        sizes = np.array([len(text.encode('utf-8', 'surrogatepass')) for text in texts], dtype=float)
+        token_counts = np.array(count_tokens_batch(texts, tokenizers.get(encoding_name)), dtype=float)
+        if token_counts.sum() == 0:
+            continue
+        ratio = sizes.sum() / token_counts.sum()
+        estimates = sizes / ratio
+        nonzero = token_counts > 0
+        part_error = float(np.mean(np.abs(estimates[nonzero] - token_counts[nonzero]) / token_counts[nonzero]))
+        # Standard error of the ratio estimator, relative to the estimated total
+        residuals = token_counts - estimates
+        total_error = 1.96 * float(np.sqrt(np.sum(residuals ** 2) / max(len(texts) - 1, 1)) * np.sqrt(len(texts))
+                                   / token_counts.sum())
+        ratios[encoding_name] = float(ratio)
+        error_bounds[encoding_name] = {'part': part_error, 'total': total_error, 'sample_size': len(texts)}
+        print(f"{encoding_name}: {ratio:.2f} bytes per token, mean error per part {part_error:.1%}, "
+              f"on totals +/-{total_error:.1%} (95%, {len(texts)} parts)")
+    print("Calibration completed.")
+    return ApproximateTokenCounter(ratios, error_bounds)
+
+def load_or_calibrate_estimator(file_path, tokenizers, estimator_path=ESTIMATOR_PATH, recalibrate=False):
+    """Reuse the estimator saved by a previous run, or calibrate one on the export and save it."""
+    if os.path.exists(estimator_path) and not recalibrate:
+        print(f"Using token estimator from {estimator_path}.")
+        return ApproximateTokenCounter.load(estimator_path)
+    with closing(iter_conversations(file_path)) as conversations:
+        estimator = calibrate_estimator(conversations, tokenizers)
+    estimator.save(estimator_path)
+    return estimator
+
+class TokenCountCache:
+    """Persistent SQLite cache of token counts keyed by encoding name and content hash.
+
+    Entries carry a last-used timestamp; once the cache grows beyond max_entries the least
+    recently used ones are evicted. Several processes may share the same cache file.
+    """
+
+    def __init__(self, path=TOKEN_CACHE_PATH, max_entries=TOKEN_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._connection = sqlite3.connect(path, timeout=60)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS token_counts ("
+            "encoding TEXT NOT NULL, digest BLOB NOT NULL, token_count INTEGER NOT NULL, last_used INTEGER NOT NULL, "
+            "PRIMARY KEY (encoding, digest)) WITHOUT ROWID")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS token_counts_last_used ON token_counts (last_used)")
+        self._connection.commit()
+        self._entries = self._connection.execute("SELECT COUNT(*) FROM token_counts").fetchone()[0]
+
+    @staticmethod
+    def content_hash(text):
+        """Hash a text into the key stored in the cache."""
+        return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+    def lookup(self, encoding_name, texts):
+        """Return the hashes of the texts and their cached token counts, None where not cached."""
+        digests = [self.content_hash(text) for text in texts]
+        found = {}
+        unique_digests = list(set(digests))
+        # Stay below SQLite's limit on the number of query parameters
+        for start in range(0, len(unique_digests), 500):
+            chunk = unique_digests[start:start + 500]
+            rows = self._connection.execute(
+                f"SELECT digest, token_count FROM token_counts WHERE encoding = ? AND digest IN ({','.join('?' * len(chunk))})",
+                [encoding_name, *chunk])
+            found.update(rows)
+        if found:
+            now = time.time_ns()
+            self._connection.executemany(
+                "UPDATE token_counts SET last_used = ? WHERE encoding = ? AND digest = ?",
+                [(now, encoding_name, digest) for digest in found])
+            self._connection.commit()
+        token_counts = [found.get(digest) for digest in digests]
+        hits = sum(count is not None for count in token_counts)
+        self.hits += hits
+        self.misses += len(token_counts) - hits
+        return digests, token_counts
+
+    def store(self, encoding_name, digests, token_counts):
+        """Add freshly computed token counts, evicting the least recently used entries if needed."""
+        now = time.time_ns()
+        cursor = self._connection.executemany(
+            "INSERT OR REPLACE INTO token_counts (encoding, digest, token_count, last_used) VALUES (?, ?, ?, ?)",
+            [(encoding_name, digest, count, now) for digest, count in zip(digests, token_counts)])
+        self._entries += cursor.rowcount
+        self._connection.commit()
+        if self._entries > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits in max_entries."""
+        self._entries = self._connection.execute("SELECT COUNT(*) FROM token_counts").fetchone()[0]
+        excess = self._entries - self.max_entries
+        if excess > 0:
+            self._connection.execute(
+                "DELETE FROM token_counts WHERE (encoding, digest) IN "
+                "(SELECT encoding, digest FROM token_counts ORDER BY last_used LIMIT ?)", (excess,))
+            self._connection.commit()
+            self._entries -= excess
+
+    def hit_rate(self):
+        """Fraction of lookups answered from the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def close(self):
+        """Close the underlying database connection."""
+        self._connection.close()
+
+@contextmanager
+def open_conversations(file_path):
+    """Open the conversations of an export as a text stream.
+
+    file_path is either conversations.json or the export's .zip archive, in which case
+    conversations.json is decompressed on the fly as it is read, without extracting it to disk.
+    """
+    if not zipfile.is_zipfile(file_path):
+        with open(file_path, 'r') as file:
+            yield file
+        return
+    with zipfile.ZipFile(file_path) as archive:
+        members = [name for name in archive.namelist() if os.path.basename(name) == 'conversations.json']
+        if not members:
+            raise ValueError(f"No conversations.json found in {file_path}")
+        # Prefer the file at the top of the archive if it was zipped with a folder
+        member = min(members, key=lambda name: name.count('/'))
+        with io.TextIOWrapper(archive.open(member), encoding='utf-8') as file:
+            yield file
+
+def read_conversation_json(file_path, stream=False):
+    """Read and parse the JSON file containing the conversation data. And returns a dict
+
+    With stream=True a generator is returned instead, yielding one conversation at a time
+    so only the conversation currently being decoded is held in memory. file_path may also
+    be the export's .zip archive.
+    """
+    if stream:
+        print(f"Streaming data from {file_path}...")
+        return iter_conversations(file_path)
     print(f"Reading data from {file_path}...")
-    with open(file_path, 'r') as file:
+    with open_conversations(file_path) as file:
         data = json.load(file)
     print("Data reading completed.")
     return data
 
-def extract_token_usage(data, tokenizers):
-    """Extract the monthly token usage from the conversation data."""
+def iter_conversations(file_path, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield the conversations of an export one by one without loading the whole file."""
+    with open_conversations(file_path) as file:
+        yield from _iter_json_array(file, chunk_size)
+
+def _iter_json_array(file, chunk_size=STREAM_CHUNK_SIZE):
+    """Incrementally decode the elements of a top-level JSON array read from a text stream."""
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = '', 0, False
+    started = False
+    while True:
+        separators = ' \t\r\n\ufeff,' if started else ' \t\r\n\ufeff'
+        while pos < len(buffer) and buffer[pos] in separators:
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                raise ValueError("Unexpected end of data while reading the conversation array")
+            chunk = file.read(chunk_size)
+            buffer, pos, eof = chunk, 0, not chunk
+            continue
+        if not started:
+            if buffer[pos] != '[':
+                raise ValueError("Expected a JSON array of conversations")
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == ']':
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # The element is incomplete: grow the buffer at least geometrically so that
+            # re-decoding a very large conversation stays linear overall.
+            chunk = file.read(max(chunk_size, len(buffer) - pos))
+            buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+            continue
+        yield value
+        pos = end
+
+class UsageMatrix:
+    """Token counts per month, model and token type, backed by a single NumPy array.
+
+    Months and models are interned into axis positions the first time they are seen, so adding
+    tokens is an O(1) array increment and reading never inserts entries. counts is an int64
+    array of shape (months, models, len(TOKEN_TYPES)) in the order of the months and models lists.
+    """
+
+    def __init__(self):
+        self.months = []
+        self.models = []
+        self._month_index = {}
+        self._model_index = {}
+        self._counts = np.zeros((4, 2, len(TOKEN_TYPES)), dtype=np.int64)
+
+    @property
+    def counts(self):
+        """View of the counts of the known months and models."""
+        return self._counts[:len(self.months), :len(self.models)]
+
+    def _index(self, key, keys, index, axis):
+        """Return the position of key on an axis, appending it (and growing the array) if new."""
+        position = index.get(key)
+        if position is None:
+            position = index[key] = len(keys)
+            keys.append(key)
+            if position == self._counts.shape[axis]:
+                padding = [(0, 0)] * 3
+                padding[axis] = (0, position)
+                self._counts = np.pad(self._counts, padding)
+        return position
+
+    def month_index(self, month):
+        """Return the position of a month, adding it if new."""
+        return self._index(month, self.months, self._month_index, 0)
+
+    def model_index(self, model):
+        """Return the position of a model, adding it if new."""
+        return self._index(model, self.models, self._model_index, 1)
+
+    def add(self, month, model, token_type, count):
+        """Add count tokens of the given type."""
+        # Resolve the positions first: interning a new month or model may replace the array
+        position = self.month_index(month), self.model_index(model), TOKEN_TYPE_INDEX[token_type]
+        self._counts[position] += count
+
+    def get(self, month, model, token_type):
+        """Return the number of tokens of the given type, 0 if the month or model is unknown."""
+        month_position = self._month_index.get(month)
+        model_position = self._model_index.get(model)
+        if month_position is None or model_position is None:
+            return 0
+        return int(self._counts[month_position, model_position, TOKEN_TYPE_INDEX[token_type]])
+
+    def merge(self, other):
+        """Add all the counts of another UsageMatrix."""
+        if not other.months or not other.models:
+            return
+        month_positions = [self.month_index(month) for month in other.months]
+        model_positions = [self.model_index(model) for model in other.models]
+        self._counts[np.ix_(month_positions, model_positions)] += other.counts
+
+    def sorted(self):
+        """Return a copy with months and models in sorted order, as used for reporting."""
+        result = UsageMatrix()
+        for month in sorted(self.months):
+            result.month_index(month)
+        for model in sorted(self.models):
+            result.model_index(model)
+        result.merge(self)
+        return result
+
+    def scaled(self, factor):
+        """Return a copy with every count multiplied by factor and rounded."""
+        result = UsageMatrix()
+        result.merge(self)
+        result._counts = np.rint(result._counts * factor).astype(np.int64)
+        return result
+
+    def to_dict(self):
+        """Convert to plain JSON-serializable data."""
+        return {'months': self.months, 'models': self.models, 'token_types': list(TOKEN_TYPES),
+                'counts': self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a UsageMatrix from the output of to_dict."""
+        result = cls()
+        if not data['months'] or not data['models']:
+            return result
+        month_positions = [result.month_index(month) for month in data['months']]
+        model_positions = [result.model_index(model) for model in data['models']]
+        type_positions = [TOKEN_TYPE_INDEX[token_type] for token_type in data['token_types']]
+        result._counts[np.ix_(month_positions, model_positions, type_positions)] += np.array(data['counts'], dtype=np.int64)
+        return result
+
+def count_tokens_cached(texts, tokenizer, cache=None, batch_size=TOKENIZE_BATCH_SIZE, num_threads=TOKENIZE_THREADS):
+    """Count the tokens of many texts, only tokenizing those missing from the cache."""
+    if cache is None:
+        return count_tokens_batch(texts, tokenizer, batch_size, num_threads)
+    digests, token_counts = cache.lookup(tokenizer.name, texts)
+    missing = [i for i, count in enumerate(token_counts) if count is None]
+    if missing:
+        fresh_counts = count_tokens_batch([texts[i] for i in missing], tokenizer, batch_size, num_threads)
+        for i, count in zip(missing, fresh_counts):
+            token_counts[i] = count
+        cache.store(tokenizer.name, [digests[i] for i in missing], fresh_counts)
+    return token_counts
+
+def image_tokens(width, height):
+    """Return the tokens of an image of the given size, or the base cost if its size is unknown."""
+    if not width or not height:
+        return IMAGE_BASE_TOKENS
+    scale = min(1.0, IMAGE_MAX_SIDE / max(width, height))
+    scale *= min(1.0, IMAGE_SHORT_SIDE / (min(width, height) * scale))
+    tiles = math.ceil(width * scale / IMAGE_TILE_SIZE) * math.ceil(height * scale / IMAGE_TILE_SIZE)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+def _image_part_tokens(part):
+    return {'image': image_tokens(part.get('width'), part.get('height'))}
+
+def _audio_part_tokens(part):
+    metadata = part.get('metadata') or {}
+    if metadata.get('end') is None:
+        return {}
+    duration = metadata['end'] - (metadata.get('start') or 0)
+    return {'audio': math.ceil(max(duration, 0) * AUDIO_TOKENS_PER_SECOND)}
+
+def _real_time_part_tokens(part):
+    # Voice conversations with video carry the audio and the video frames sent to the model
+    tokens = _audio_part_tokens(part.get('audio_asset_pointer') or {})
+    frames = part.get('frames_asset_pointers') or []
+    if frames:
+        tokens['image'] = sum(_image_part_tokens(frame)['image'] for frame in frames)
+    return tokens
+
+def _no_tokens(part):
+    return {}
+
+# Token counters of the non-text parts, by content type. The content of files and the
+# transcriptions of audio reach the model separately, so their parts count no tokens.
+MEDIA_PART_HANDLERS = {
+    'image_asset_pointer': _image_part_tokens,
+    'audio_asset_pointer': _audio_part_tokens,
+    'real_time_user_audio_video_asset_pointer': _real_time_part_tokens,
+    'file_asset_pointer': _no_tokens,
+    'audio_transcription': _no_tokens,
+}
+
+def _split_parts(parts):
+    """Split message parts into the texts to tokenize and the tokens of each media type.
+
+    Media parts are dispatched on their content type and counted from their metadata; dict parts
+    of unknown types are tokenized as JSON.
+    """
+    texts = []
+    media = dict.fromkeys(MEDIA_TYPES, 0)
+    for part in parts:
+        if not part:
+            continue
+        if not isinstance(part, dict):
+            texts.append(part)
+            continue
+        handler = MEDIA_PART_HANDLERS.get(part.get('content_type'))
+        if handler is None:
+            texts.append(json.dumps(part))
+            continue
+        for media_type, tokens in handler(part).items():
+            media[media_type] += tokens
+    return texts, tuple(media[media_type] for media_type in MEDIA_TYPES)
+
+def _content_parts(content):
+    """Return the parts of a message's content.
+
+    Text, code and tool output content keeps its text in a "text" or "result" field instead of
+    parts, the reasoning of reasoning models in a list of thoughts, and custom instructions in
+    their "user_profile" and "user_instructions" fields.
+    """
+    if 'parts' in content:
+        return content['parts']
+    if content.get('content_type') == 'user_editable_context':
+        return [text for text in (content.get('user_profile'), content.get('user_instructions')) if text] or ['']
+    if content.get('content_type') == 'thoughts':
+        return [thought.get('content') or thought.get('summary') or '' for thought in content.get('thoughts', [])]
+    return [content.get('text') or content.get('result') or '']
+
+def _collect_messages(conversation, tokenizers):
+    """List the messages of a conversation that take part in token accounting.
+
+    Each entry is a (node_id, create_time, month_key, model, author_role, encoding_name, texts, media)
+    tuple, where month_key is None for messages without a create_time and media holds the tokens of
+    each of MEDIA_TYPES. Messages without a model slug of their own (such as user messages) use the
+    conversation's default model. The recorded reasoning of reasoning models gets the author role
+    "reasoning", and custom instructions the role "system".
+    """
+    default_slug = conversation.get('default_model_slug')
+    messages = []
+    for node_id, message_data in conversation['mapping'].items():
+        try:
+            message = message_data.get('message') or {}
+            content = message.get('content', {})
+            message_content = _content_parts(content)
+            author_role = message.get('author', {}).get('role', '')
+            if author_role == 'assistant' and content.get('content_type') == 'thoughts':
+                author_role = 'reasoning'
+            elif content.get('content_type') == 'user_editable_context':
+                # Custom instructions are sent to the model as part of the system prompt
+                author_role = 'system'
+            create_time = message.get('create_time')
+            model_slug = message.get('metadata', {}).get('model_slug') or default_slug
+
+            if (author_role in CONTEXT_ROLES or author_role == 'reasoning') and message_content and message_content[0]:
+                month_key = datetime.fromtimestamp(create_time).strftime('%Y-%m') if create_time else None
+                model, encoding_name = tokenizers.resolve(model_slug)
+                texts, media = _split_parts(message_content)
+                messages.append((node_id, create_time, month_key, model, author_role, encoding_name, texts, media))
+        except AttributeError:
+            pass
+    return messages
+
+def context_window(model):
+    """Return the number of tokens of context the model accepts."""
+    return COSTS.get(model, {}).get("context_window", DEFAULT_CONTEXT_WINDOW)
+
+def reasoning_multiplier(model):
+    """Return the estimated hidden reasoning tokens per output token of a model, 0 for non-reasoning models."""
+    return COSTS.get(model, {}).get("reasoning_multiplier", 0.0)
+
+def cached_prompt_tokens(previous_prompt_tokens, prompt_tokens):
+    """Return how many tokens of a prompt are read from the cache when it extends a previous prompt.
+
+    As with the API, only prefixes of at least PROMPT_CACHE_MIN_TOKENS are cached, in
+    increments of PROMPT_CACHE_INCREMENT tokens.
+    """
+    reusable = min(previous_prompt_tokens, prompt_tokens)
+    if reusable < PROMPT_CACHE_MIN_TOKENS:
+        return 0
+    return reusable - reusable % PROMPT_CACHE_INCREMENT
+
+def _bill_conversation_tree(mapping, message_tokens, usage):
+    """Walk a conversation tree from its roots and add the tokens billed for each assistant turn.
+
+    Each assistant message is billed as output with its ancestors, truncated to the model's
+    context window, as input, so branches and regenerations are each billed with their own context.
+    """
+    no_media = (0,) * len(MEDIA_TYPES)
+    roots = [node_id for node_id, node in mapping.items() if node.get('parent') not in mapping]
+    # Stack entries carry the context window heads (oldest path index kept per window size), the
+    # last call on the path and the recorded reasoning not yet billed, so backtracking restores them
+    stack = [(node_id, 0, {}, None, 0) for node_id in reversed(roots)]
+    # Prefix sums along the current path of all tokens, of media tokens and of each role's tokens
+    path_tokens = [0]
+    path_media = [no_media]
+    path_roles = [(0,) * len(CONTEXT_ROLES)]
+    # Last call made for each parent node, so regenerations can reuse the prompt of their siblings
+    calls_by_parent = {}
+    visited = set()
+    while stack:
+        node_id, depth, heads, last_call, reasoning_tokens = stack.pop()
+        if node_id in visited:
+            continue
+        visited.add(node_id)
+        del path_tokens[depth + 1:]
+        del path_media[depth + 1:]
+        del path_roles[depth + 1:]
+        context_tokens = path_tokens[depth]
+        token_count = 0
+        author_role = None
+        media = no_media
+        message = message_tokens.get(node_id)
+        if message is not None:
+            create_time, month_key, model, author_role, token_count, media = message
+            if author_role == 'reasoning':
+                reasoning_tokens += token_count
+                token_count = 0
+            elif author_role == 'assistant' and month_key:
+                window = context_window(model)
+                head = heads.get(window, 0)
+                # Drop the oldest messages until the context fits, always keeping the latest one
+                while head < depth - 1 and context_tokens - path_tokens[head] > window:
+                    head += 1
+                heads = {**heads, window: head}
+                prompt_tokens = min(context_tokens - path_tokens[head], window)
+
+                cached_tokens = 0
+                parent_id = mapping[node_id].get('parent')
+                for previous_call in (last_call, calls_by_parent.get(parent_id)):
+                    if previous_call is None:
+                        continue
+                    previous_model, previous_head, previous_prompt_tokens, previous_time = previous_call
+                    if (previous_model == model and previous_head == head and create_time and previous_time
+                            and 0 <= create_time - previous_time <= PROMPT_CACHE_TTL):
+                        cached_tokens = max(cached_tokens, cached_prompt_tokens(previous_prompt_tokens, prompt_tokens))
+                last_call = calls_by_parent[parent_id] = (model, head, prompt_tokens, create_time)
+
+                # Messages after the last one entirely within the cached prefix
+                uncached_from = bisect_right(path_tokens, path_tokens[head] + cached_tokens, head, depth + 1) - 1
+                uncached_tokens = prompt_tokens - cached_tokens
+                for i, media_type in enumerate(MEDIA_TYPES):
+                    media_tokens = min(path_media[depth][i] - path_media[uncached_from][i], uncached_tokens)
+                    usage.add(month_key, model, media_type, media_tokens)
+                    usage.add(month_key, model, f"{media_type}_output", media[i])
+                    uncached_tokens -= media_tokens
+
+                usage.add(month_key, model, 'input', uncached_tokens)
+                usage.add(month_key, model, 'cached', cached_tokens)
+                usage.add(month_key, model, 'output', token_count - sum(media))
+                # Recorded thoughts are summaries of the reasoning, so they are only a lower bound
+                estimated_reasoning = round((token_count - sum(media)) * reasoning_multiplier(model))
+                usage.add(month_key, model, 'reasoning', max(reasoning_tokens, estimated_reasoning))
+                for role_type, total, head_total in zip(ROLE_TYPES, path_roles[depth], path_roles[head]):
+                    usage.add(month_key, model, role_type, min(total - head_total, prompt_tokens))
+        path_tokens.append(context_tokens + token_count)
+        path_media.append(tuple(total + tokens for total, tokens in zip(path_media[depth], media)))
+        path_roles.append(tuple(total + (token_count if role == author_role else 0)
+                                for role, total in zip(CONTEXT_ROLES, path_roles[depth])))
+        if author_role == 'assistant':
+            reasoning_tokens = 0
+        for child_id in reversed(mapping[node_id].get('children', [])):
+            if child_id in mapping:
+                stack.append((child_id, depth + 1, heads, last_call, reasoning_tokens))
+
+def _conversation_key(conversation):
+    """Return the id identifying a conversation across exports, or None if it has none."""
+    return conversation.get('conversation_id') or conversation.get('id')
+
+def _accumulate_conversations(conversations, tokenizers, usage,
+                              batch_size=TOKENIZE_BATCH_SIZE, num_threads=TOKENIZE_THREADS, cache=None,
+                              conversation_usage=None, estimator=None):
+    """Add the token usage of a group of conversations and return the number of messages processed.
+
+    The message parts of the whole group are tokenized together, one batch call per encoding, skipping
+    the texts whose count is already in the cache, or estimated by the estimator if one is given.
+    If a conversation_usage dict is given, the usage of each conversation is also recorded in it
+    under the conversation id.
+    """
+    conversation_messages = [_collect_messages(conversation, tokenizers) for conversation in conversations]
+
+    texts_by_encoding = defaultdict(list)
+    for messages in conversation_messages:
+        for *_, encoding_name, texts, _media in messages:
+            texts_by_encoding[encoding_name].extend(texts)
+    if estimator is not None:
+        counts_by_encoding = {name: iter(estimator.count(texts, name)) for name, texts in texts_by_encoding.items()}
+    else:
+        counts_by_encoding = {
+            name: iter(count_tokens_cached(texts, tokenizers.get(name), cache, batch_size, num_threads))
+            for name, texts in texts_by_encoding.items()
+        }
+
+    for conversation, messages in zip(conversations, conversation_messages):
+        message_tokens = {
+            node_id: (create_time, month_key, model, author_role,
+                      sum(next(counts_by_encoding[encoding_name]) for _ in texts) + sum(media), media)
+            for node_id, create_time, month_key, model, author_role, encoding_name, texts, media in messages
+        }
+        key = _conversation_key(conversation)
+        if conversation_usage is None or key is None:
+            _bill_conversation_tree(conversation['mapping'], message_tokens, usage)
+            continue
+        single_usage = UsageMatrix()
+        _bill_conversation_tree(conversation['mapping'], message_tokens, single_usage)
+        usage.merge(single_usage)
+        conversation_usage[key] = {'update_time': conversation.get('update_time'), 'usage': single_usage.to_dict()}
+    return sum(len(conversation['mapping']) for conversation in conversations)
+
+def _report_progress(previous, processed, total):
+    """Print progress every 100 messages."""
+    if processed // 100 > previous // 100 or processed == total:
+        print(f"Processed {processed}/{total or '?'} messages...")
+
+def _iter_shards(data, shard_size):
+    """Group conversations into lists of at most shard_size conversations."""
+    shard = []
+    for conversation in data:
+        shard.append(conversation)
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+# Tokenizers and token cache of a worker process of the parallel extraction engine, set up by _init_worker
+_worker_tokenizers = None
+_worker_cache = None
+_worker_estimator = None
+
+def _init_worker(cache_path=None, cache_max_entries=TOKEN_CACHE_MAX_ENTRIES, estimator=None):
+    """Load the tokenizers and open the token cache once per worker process."""
+    global _worker_tokenizers, _worker_cache, _worker_estimator
+    _worker_tokenizers = load_tokenizers()
+    _worker_estimator = estimator
+    if cache_path is not None:
+        _worker_cache = TokenCountCache(cache_path, cache_max_entries)
+
+def _extract_shard(conversations, batch_size, num_threads, per_conversation):
+    """Extract the partial usage of a shard of conversations inside a worker process."""
+    usage = UsageMatrix()
+    conversation_usage = {} if per_conversation else None
+    hits, misses = (_worker_cache.hits, _worker_cache.misses) if _worker_cache else (0, 0)
+    processed_messages = _accumulate_conversations(
+        conversations, _worker_tokenizers, usage, batch_size, num_threads, _worker_cache, conversation_usage,
+        _worker_estimator)
+    if _worker_cache:
+        hits, misses = _worker_cache.hits - hits, _worker_cache.misses - misses
+    return usage, processed_messages, hits, misses, conversation_usage
+
+def extract_token_usage(data, tokenizers, workers=1, shard_size=SHARD_SIZE,
+                        batch_size=TOKENIZE_BATCH_SIZE, num_threads=TOKENIZE_THREADS, cache=None,
+                        conversation_usage=None, estimator=None):
+    """Extract the monthly token usage from the conversation data.
+
+    `data` may be a list of conversations or any iterable, such as the generator returned by
+    read_conversation_json(..., stream=True); it is consumed in a single pass.
+
+    With workers > 1 conversations are sharded across a process pool whose workers load their own
+    tokenizers. Partial results are merged in shard order, so the totals are identical to the
+    serial path whatever the number of workers.
+
+    Message parts are tokenized in batches of batch_size texts per encoding with tiktoken's
+    multi-threaded encode_ordinary_batch, using num_threads threads. When a TokenCountCache is
+    given, counts of previously seen texts are read from it instead of being recomputed.
+
+    If a conversation_usage dict is given, it is filled with the usage of every conversation
+    keyed by conversation id, as stored by the incremental mode.
+
+    If an ApproximateTokenCounter is given as estimator, token counts are estimated from text
+    sizes instead: tiktoken and the cache are not used at all.
+    """
     print("Extracting token usage from conversation data...")
-    monthly_model_usage_input = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-    monthly_model_usage_output = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+    usage = UsageMatrix()
 
-    total_messages = sum(len(conversation['mapping']) for conversation in data)
+    # The total is only known up front when the whole export has been loaded
+    total_messages = sum(len(conversation['mapping']) for conversation in data) if isinstance(data, list) else None
     processed_messages = 0
 
-    for conversation in data:
-        cumulative_input_tokens = 0
-        for message_id, message_data in conversation['mapping'].items():
-            processed_messages += 1
-            try:
-                message_content = message_data.get('message', {}).get('content', {}).get('parts', [''])
-                author_role = message_data.get('message', {}).get('author', {}).get('role', '')
-                create_time = message_data.get('message', {}).get('create_time')
-                model_slug = message_data.get('message', {}).get('metadata', {}).get('model_slug')
-                children = message_data.get('children', [])
-                
-                if create_time and message_content[0] and model_slug:
-                    month_key = datetime.fromtimestamp(create_time).strftime('%Y-%m')
-                    model = MODEL_MAPPINGS.get(model_slug, 'gpt-4o')
-                    tokenizer = tokenizers.get(model_slug, tokenizers['gpt-4o'])
-                    for part in message_content:
-                        if isinstance(part, dict):
-                            part = json.dumps(part)
-                        
-                        token_count = count_tokens(part, tokenizer)
-
-                        # Cap cumulative token count at 32,000
-                        if cumulative_input_tokens + token_count > 32000:
-                            token_count = 32000 - cumulative_input_tokens  # Adjust token count to not exceed the limit
-                            cumulative_input_tokens = 32000  # Cap the cumulative count
-                        else:
-                            cumulative_input_tokens += token_count
-
-                        if author_role == 'user':
-                            monthly_model_usage_input[month_key][model]['input'] += token_count
-
-                        elif author_role == 'assistant':
-                            monthly_model_usage_output[month_key][model]['output'] += token_count
-                            if children:  # Consider tokens for input if there are follow-up messages
-                                monthly_model_usage_input[month_key][model]['input'] += token_count
-            except AttributeError:
-                pass
-            
-            if processed_messages % 100 == 0 or processed_messages == total_messages:
-                print(f"Processed {processed_messages}/{total_messages} messages...")
+    if workers <= 1:
+        for shard in _iter_shards(data, shard_size):
+            previous = processed_messages
+            processed_messages += _accumulate_conversations(
+                shard, tokenizers, usage, batch_size, num_threads, cache,
+                conversation_usage, estimator)
+            _report_progress(previous, processed_messages, total_messages)
+    else:
+        print(f"Using {workers} worker processes...")
+        initargs = (cache.path if cache else None, cache.max_entries if cache else TOKEN_CACHE_MAX_ENTRIES, estimator)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+            # Bound the number of shards in flight so streamed input is not read ahead entirely
+            pending = deque()
+
+            def merge_next():
+                nonlocal processed_messages
+                partial_usage, count, hits, misses, partial_conversations = pending.popleft().result()
+                if partial_conversations:
+                    conversation_usage.update(partial_conversations)
+                if cache:
+                    cache.hits += hits
+                    cache.misses += misses
+                usage.merge(partial_usage)
+                previous = processed_messages
+                processed_messages += count
+                _report_progress(previous, processed_messages, total_messages)
 
+            for shard in _iter_shards(data, shard_size):
+                pending.append(executor.submit(
+                    _extract_shard, shard, batch_size, num_threads, conversation_usage is not None))
+                if len(pending) >= 2 * workers:
+                    merge_next()
+            while pending:
+                merge_next()
+
+    if cache:
+        print(f"Token cache: {cache.hits:,} hits, {cache.misses:,} misses ({cache.hit_rate():.1%} hit rate).")
     print("Token usage extraction completed.")
-    return monthly_model_usage_input, monthly_model_usage_output
-
-def calculate_cost(input_usage, output_usage):
-    """Calculate the cost based on input and output tokens for each model."""
-    total_cost = 0.0
-    for model, usage in input_usage.items():
-        input_tokens = usage['input']
-        output_tokens = output_usage.get(model, {}).get('output', 0)
-        model_cost = (input_tokens / 1_000_000 * COSTS[model]["input"]) + (output_tokens / 1_000_000 * COSTS[model]["output"])
-        total_cost += model_cost
-
-        # input_cost = (usage['input'] / 1_000_000) * COSTS[model]["input"]
-        # output_cost = (usage['output'] / 1_000_000) * COSTS[model]["output"]
-        # total_cost += input_cost + output_cost
-    return total_cost
+    return usage
+
+def _usage_state_fingerprint(settings=None):
+    """Identify the settings stored per-conversation usage depends on."""
+    models = {model: [context_window(model), reasoning_multiplier(model), COSTS[model].get('encoding')]
+              for model in COSTS}
+    settings = json.dumps({'version': USAGE_STATE_VERSION, 'model_mappings': MODEL_MAPPINGS,
+                           'default_model': DEFAULT_MODEL, 'models': models,
+                           'prompt_cache': [PROMPT_CACHE_TTL, PROMPT_CACHE_MIN_TOKENS, PROMPT_CACHE_INCREMENT],
+                           'media': [IMAGE_BASE_TOKENS, IMAGE_TILE_TOKENS, IMAGE_TILE_SIZE, IMAGE_MAX_SIDE,
+                                     IMAGE_SHORT_SIDE, AUDIO_TOKENS_PER_SECOND],
+                           **(settings or {})}, sort_keys=True)
+    return hashlib.sha256(settings.encode()).hexdigest()
+
+def load_usage_state(state_path=USAGE_STATE_PATH, settings=None):
+    """Load the per-conversation usage stored by a previous incremental run.
+
+    Returns an empty dict if there is no state or it was produced with different settings.
+    """
+    try:
+        with open(state_path, 'r') as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable usage state {state_path}: {e}")
+        return {}
+    if state.get('fingerprint') != _usage_state_fingerprint(settings):
+        print(f"Usage state {state_path} was produced with different settings, re-extracting everything.")
+        return {}
+    return state['conversations']
+
+def save_usage_state(conversation_usage, state_path=USAGE_STATE_PATH, settings=None):
+    """Store the per-conversation usage for the next incremental run."""
+    temp_path = f"{state_path}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump({'fingerprint': _usage_state_fingerprint(settings), 'conversations': conversation_usage}, file)
+    os.replace(temp_path, state_path)
+
+def extract_token_usage_incremental(data, tokenizers, state_path=USAGE_STATE_PATH, **kwargs):
+    """Extract the monthly token usage, re-extracting only new or changed conversations.
+
+    Conversations whose id and update_time match the state stored by the previous run reuse
+    their stored usage; the others go through extract_token_usage (kwargs are passed on).
+    The state is then rewritten with the conversations of this export only.
+    """
+    # Estimated counts must not be mixed with exact ones (or with other calibrations)
+    estimator = kwargs.get('estimator')
+    settings = {'estimator': estimator.ratios if estimator else None}
+    previous_usage = load_usage_state(state_path, settings)
+    conversation_usage = {}
+    stored_usage = UsageMatrix()
+    reused = 0
+
+    def changed_conversations():
+        nonlocal reused
+        for conversation in data:
+            key = _conversation_key(conversation)
+            stored = previous_usage.get(key)
+            if stored is not None and stored['update_time'] == conversation.get('update_time'):
+                conversation_usage[key] = stored
+                stored_usage.merge(UsageMatrix.from_dict(stored['usage']))
+                reused += 1
+            else:
+                yield conversation
+
+    usage = extract_token_usage(changed_conversations(), tokenizers, conversation_usage=conversation_usage, **kwargs)
+    usage.merge(stored_usage)
+    print(f"Reused {reused} unchanged conversations from {state_path}.")
+
+    save_usage_state(conversation_usage, state_path, settings)
+    return usage
+
+def find_exports(pattern):
+    """List the exports matching a glob, or the exports in a directory.
+
+    An export is a .zip archive or a conversations.json, found directly in the directory or
+    in one of its subdirectories (one per user, as extracted exports are). Other .json files, such
+    as the usage, prices and state files written next to them, are not exports. Directories
+    matching a glob stand for the conversations.json they hold.
+    """
+    if os.path.isdir(pattern):
+        paths = [*glob.glob(os.path.join(pattern, '*.zip')), os.path.join(pattern, 'conversations.json'),
+                 *glob.glob(os.path.join(pattern, '*', 'conversations.json'))]
+    else:
+        paths = [os.path.join(path, 'conversations.json') if os.path.isdir(path) else path
+                 for path in glob.glob(pattern)]
+    return sorted(path for path in paths if os.path.isfile(path))
+
+def _extract_export(path, batch_size, num_threads):
+    """Extract the usage of a whole export inside a worker process of the batch mode."""
+    usage = UsageMatrix()
+    processed_messages = 0
+    for shard in _iter_shards(iter_conversations(path), SHARD_SIZE):
+        processed_messages += _accumulate_conversations(
+            shard, _worker_tokenizers, usage, batch_size, num_threads, _worker_cache, None, _worker_estimator)
+    return usage, processed_messages
+
+# Result of batch_token_usage. usages maps the path of every export processed to its UsageMatrix,
+# merged is the sum of all of them, and failures maps the path of the others to their error.
+BatchUsage = namedtuple('BatchUsage', ['usages', 'merged', 'failures'])
+
+def batch_token_usage(paths, workers=BATCH_WORKERS, batch_size=TOKENIZE_BATCH_SIZE, num_threads=TOKENIZE_THREADS,
+                      cache=None, estimator=None):
+    """Extract the token usage of many exports concurrently, one export per worker process at a time.
+
+    An export that cannot be read or processed is recorded in failures and does not stop the others.
+    The merged usage adds the exports up in the order of paths, whatever order they finish in.
+    """
+    print(f"Extracting token usage from {len(paths)} exports with {workers} worker processes...")
+    usages, failures = {}, {}
+    initargs = (cache.path if cache else None, cache.max_entries if cache else TOKEN_CACHE_MAX_ENTRIES, estimator)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+        futures = {executor.submit(_extract_export, path, batch_size, num_threads): path for path in paths}
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            try:
+                usages[path], processed_messages = future.result()
+            except Exception as e:
+                failures[path] = f"{type(e).__name__}: {e}"
+                print(f"Failed to process {path}: {failures[path]}")
+                continue
+            print(f"Processed {done}/{len(paths)} exports ({path}: {processed_messages} messages)...")
+
+    merged = UsageMatrix()
+    for path in paths:
+        if path in usages:
+            merged.merge(usages[path])
+    print(f"Batch extraction completed: {len(usages)} exports processed, {len(failures)} failed.")
+    return BatchUsage({path: usages[path] for path in paths if path in usages}, merged, failures)
+
+# Result of calculate_cost. usage is the costed UsageMatrix with sorted months and models;
+# model_costs is a months x models array, monthly_costs and cumulative_costs are per month.
+CostReport = namedtuple('CostReport', ['usage', 'model_costs', 'monthly_costs', 'cumulative_costs'])
+
+def price_matrix(models, costs=COSTS):
+    """Build the models x token types array of prices in USD per million tokens.
+
+    Cached and media tokens without a price of their own are priced as input tokens, and reasoning
+    and generated media tokens as output tokens.
+    """
+    prices = np.zeros((len(models), len(TOKEN_TYPES)))
+    for i, model in enumerate(models):
+        model_costs = costs[model]
+        for token_type, price in model_costs.items():
+            if token_type in TOKEN_TYPE_INDEX:
+                prices[i, TOKEN_TYPE_INDEX[token_type]] = price
+        for token_type in ('cached', *MEDIA_TYPES):
+            if token_type not in model_costs:
+                prices[i, TOKEN_TYPE_INDEX[token_type]] = model_costs.get('input', 0.0)
+        for token_type in ('reasoning', *OUTPUT_MEDIA_TYPES):
+            if token_type not in model_costs:
+                prices[i, TOKEN_TYPE_INDEX[token_type]] = model_costs.get('output', 0.0)
+    return prices
+
+class PriceBook:
+    """Versioned prices per model, each valid from an effective date until the next one.
+
+    entries maps each model to a list of price dicts (as in COSTS) with an "effective_from"
+    date in YYYY-MM-DD format. A month is priced with the entry in effect on its first day, or
+    with the earliest entry for months before it. Models missing from the book use fallback,
+    either a COSTS-style dict or another PriceBook.
+    """
+
+    def __init__(self, entries, fallback=None):
+        self.entries = {model: sorted(model_entries, key=lambda entry: entry['effective_from'])
+                        for model, model_entries in entries.items()}
+        self.fallback = fallback or {}
+
+    def __contains__(self, model):
+        """Tell whether the book or its fallback prices a model."""
+        return model in self.entries or model in self.fallback
+
+    @classmethod
+    def from_costs(cls, costs=COSTS, fallback=None):
+        """Build a price book with a single, always effective entry per model."""
+        return cls({model: [{'effective_from': '0001-01-01', **prices}] for model, prices in costs.items()}, fallback)
+
+    @classmethod
+    def load(cls, path=PRICE_BOOK_PATH, fallback=COSTS):
+        """Read a price book from a JSON or TOML file with a "models" table of entry lists.
+
+        TOML needs Python 3.11 or later, for tomllib.
+        """
+        if path.endswith('.toml'):
+            import tomllib
+            with open(path, 'rb') as file:
+                data = tomllib.load(file)
+        else:
+            with open(path, 'r') as file:
+                data = json.load(file)
+        return cls(data['models'], fallback)
+
+    def price_tensor(self, months, models):
+        """Build the months x models x token types array of prices in USD per million tokens.
+
+        The entry in effect for every month is found with one sorted search per model, and the
+        prices are then gathered for all months at once.
+        """
+        prices = np.zeros((len(months), len(models), len(TOKEN_TYPES)))
+        month_starts = np.array([f"{month}-01" for month in months])
+        for k, model in enumerate(models):
+            model_entries = self.entries.get(model)
+            if model_entries is None:
+                if isinstance(self.fallback, PriceBook):
+                    prices[:, k, :] = self.fallback.price_tensor(months, [model])[:, 0, :]
+                else:
+                    prices[:, k, :] = price_matrix([model], self.fallback)[0]
+                continue
+            effective_dates = np.array([entry['effective_from'] for entry in model_entries])
+            entry_prices = price_matrix(range(len(model_entries)), dict(enumerate(model_entries)))
+            positions = np.searchsorted(effective_dates, month_starts, side='right') - 1
+            prices[:, k, :] = entry_prices[np.maximum(positions, 0)]
+        return prices
+
+def load_price_book(path=PRICE_BOOK_PATH):
+    """Load the price book file if there is one, else use the static COSTS."""
+    if os.path.exists(path):
+        print(f"Using prices from {path}.")
+        return PriceBook.load(path)
+    return PriceBook.from_costs(COSTS)
+
+def _as_price_book(costs):
+    """Accept a PriceBook, the path of a price book file or a COSTS-style dict of static prices."""
+    if isinstance(costs, PriceBook):
+        return costs
+    if isinstance(costs, str):
+        return PriceBook.load(costs)
+    return PriceBook.from_costs(costs)
+
+def calculate_cost(usage, costs=COSTS):
+    """Calculate the cost of every month and model in one pass over the usage matrix.
+
+    costs is either a PriceBook or a COSTS-style dict of static prices.
+    """
+    usage = usage.sorted()
+    prices = _as_price_book(costs).price_tensor(usage.months, usage.models)
+    model_costs = np.einsum('mkt,mkt->mk', usage.counts, prices) / 1_000_000
+    monthly_costs = model_costs.sum(axis=1)
+    return CostReport(usage, model_costs, monthly_costs, np.cumsum(monthly_costs))
+
+# A what-if pricing. prices is a PriceBook, the path of a price book file or a COSTS-style dict,
+# and model_map maps the models of the usage to the models they would be billed as.
+PricingScenario = namedtuple('PricingScenario', ['name', 'prices', 'model_map'])
+
+# Result of compare_scenarios. model_costs is a scenarios x months x models array, monthly_costs
+# a scenarios x months array and total_costs has one total per scenario.
+ScenarioComparison = namedtuple('ScenarioComparison', ['names', 'months', 'model_costs', 'monthly_costs', 'total_costs'])
+
+def load_scenarios(path=SCENARIOS_PATH, base_prices=COSTS):
+    """Read pricing scenarios from a JSON file with a "scenarios" list of name/prices/model_map objects.
+
+    Scenario prices are laid over base_prices (a PriceBook or a COSTS-style dict): inline prices and
+    price book files only need to list the models they change, the others keep their base prices.
+    Price book paths are relative to the scenarios file. Raises ValueError if a scenario maps a model
+    to one it has no prices for.
+    """
+    base_book = _as_price_book(base_prices)
+    with open(path, 'r') as file:
+        data = json.load(file)
+    scenarios = []
+    for scenario in data['scenarios']:
+        prices = scenario.get('prices')
+        if prices is None:
+            prices = base_book
+        elif isinstance(prices, str):
+            prices = PriceBook.load(os.path.join(os.path.dirname(os.path.abspath(path)), prices), fallback=base_book)
+        else:
+            prices = PriceBook.from_costs(prices, fallback=base_book)
+        model_map = scenario.get('model_map', {})
+        for model, mapped_model in model_map.items():
+            if mapped_model not in prices:
+                raise ValueError(f"Scenario {scenario['name']!r} maps {model} to {mapped_model}, which it has no prices for")
+        scenarios.append(PricingScenario(scenario['name'], prices, model_map))
+    return scenarios
+
+def compare_scenarios(usage, scenarios):
+    """Cost the same usage under several pricing scenarios at once.
+
+    The price tensors of all scenarios are stacked and contracted with the usage in a single
+    pass, so each additional scenario only costs building its price tensor.
+    """
+    usage = usage.sorted()
+    tensors = np.stack([
+        _as_price_book(scenario.prices).price_tensor(
+            usage.months, [scenario.model_map.get(model, model) for model in usage.models])
+        for scenario in scenarios
+    ])
+    model_costs = np.einsum('mkt,smkt->smk', usage.counts, tensors) / 1_000_000
+    monthly_costs = model_costs.sum(axis=2)
+    return ScenarioComparison([scenario.name for scenario in scenarios], usage.months, model_costs, monthly_costs,
+                              monthly_costs.sum(axis=1))
+
+def print_scenario_comparison(comparison):
+    """Print the monthly and total cost of every scenario side by side."""
+    print("Comparing pricing scenarios...")
+    print(f'{"Month":<10}' + ''.join(f'{name[:19]:>20}' for name in comparison.names))
+    for i, month in enumerate(comparison.months):
+        print(f'{month:<10}' + ''.join(f'{cost:>20,.2f}' for cost in comparison.monthly_costs[:, i]))
+    print('-' * (10 + 20 * len(comparison.names)))
+    print(f'{"TOTAL":<10}' + ''.join(f'{cost:>20,.2f}' for cost in comparison.total_costs))
+    cheapest = int(np.argmin(comparison.total_costs))
+    print(f"Cheapest scenario: {comparison.names[cheapest]} ({comparison.total_costs[cheapest]:,.2f} USD).")
+
+def plot_scenario_comparison(comparison, output=None):
+    """Plot the cumulative cost of every scenario, to the output file if one is given."""
+    print("Plotting scenario comparison...")
+    if output is not None:
+        check_plot_output(output)
+    plt = _pyplot(headless=output is not None)
+    fig, ax = plt.subplots(figsize=(10, 6))
+    x = range(len(comparison.months))
+    for name, monthly_costs in zip(comparison.names, comparison.monthly_costs):
+        ax.plot(x, np.cumsum(monthly_costs), marker='o', label=name)
+    ax.set_xlabel('Month')
+    ax.set_ylabel('Cumulative Cost (USD)')
+    ax.set_title('Cumulative Cost by Pricing Scenario')
+    ax.set_xticks(x)
+    ax.set_xticklabels(comparison.months, rotation=45, ha='right')
+    ax.legend()
+    plt.tight_layout()
+    _show_or_save(plt, fig, output)
+    print("Plotting completed.")
+
+# Result of break_even_analysis. savings and cumulative_savings are tiers x months arrays of
+# what paying per use saves over each subscription (negative when the subscription is cheaper),
+# and break_even_months maps each tier to the months in which the API cost more than it.
+BreakEvenReport = namedtuple('BreakEvenReport', ['months', 'api_costs', 'tiers', 'fees', 'savings',
+                                                 'cumulative_savings', 'break_even_months', 'recommendation'])
+
+def break_even_analysis(cost_report, tiers=SUBSCRIPTION_TIERS):
+    """Compare the monthly API cost of a cost report with each subscription tier."""
+    names = list(tiers)
+    fees = np.array([tiers[name] for name in names], dtype=float)
+    api_costs = np.asarray(cost_report.monthly_costs, dtype=float)
+    savings = fees[:, np.newaxis] - api_costs[np.newaxis, :]
+    cumulative_savings = np.cumsum(savings, axis=1)
+    break_even_months = {name: [month for month, saving in zip(cost_report.usage.months, row) if saving < 0]
+                         for name, row in zip(names, savings)}
+    # Recommend whatever would have been cheapest over the whole period
+    totals = {'API': float(api_costs.sum()), **{name: float(fee) * len(api_costs) for name, fee in zip(names, fees)}}
+    recommendation = min(totals, key=totals.get)
+    return BreakEvenReport(cost_report.usage.months, api_costs, names, fees, savings, cumulative_savings,
+                           break_even_months, recommendation)
+
+def print_break_even(report):
+    """Print the savings of paying per use over each subscription tier and the recommendation."""
+    print("Comparing API cost with subscriptions...")
+    print(f'{"Month":<10}{"API (USD)":>15}' + ''.join(f'{f"Saved vs {name}":>20}' for name in report.tiers))
+    for i, month in enumerate(report.months):
+        print(f'{month:<10}{report.api_costs[i]:>15,.2f}'
+              + ''.join(f'{saving:>20,.2f}' for saving in report.cumulative_savings[:, i]))
+    print('-' * (25 + 20 * len(report.tiers)))
+    for name, fee in zip(report.tiers, report.fees):
+        months = report.break_even_months[name]
+        print(f"{name} ({fee:,.2f} USD/month): the API cost more in {len(months)} of {len(report.months)} months"
+              + (f" ({', '.join(months)})." if months else "."))
+    if report.recommendation == 'API':
+        print("Recommendation: pay per use with the API.")
+    else:
+        print(f"Recommendation: subscribe to {report.recommendation}.")
+
+# Result of estimate_cost_sampled. cost_report holds the extrapolated usage and costs, and
+# monthly_margins the half-width of the confidence interval of each monthly cost.
+SampledCostReport = namedtuple('SampledCostReport', ['cost_report', 'monthly_margins', 'confidence',
+                                                     'sampled_conversations', 'total_conversations'])
+
+def _is_sampled(key, fraction, seed):
+    """Decide reproducibly, from the conversation id alone, whether a conversation is in the sample."""
+    digest = hashlib.blake2b(f"{seed}:{key}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') < fraction * 2 ** 64
+
+def estimate_cost_sampled(data, tokenizers, fraction=SAMPLE_FRACTION, seed=SAMPLE_SEED, confidence=0.95,
+                          costs=COSTS, **kwargs):
+    """Estimate usage and monthly costs from a stratified random sample of conversations.
+
+    Conversations are stratified by the month they were started in and their model, and each is
+    sampled with probability fraction, reproducibly for a given seed (the first conversation of a
+    stratum is always sampled so that every stratum has an estimate). Only sampled conversations
+    are tokenized, by extract_token_usage (kwargs are passed on). Totals are extrapolated per
+    stratum with a ratio estimator on the text size of the conversations, which is known for all
+    of them, and every monthly cost gets a normal-approximation confidence interval.
+
+    Whole conversations are sampled rather than single messages because the tokens billed for a
+    message depend on the rest of its conversation.
+    """
+    print(f"Sampling {fraction:.1%} of conversations (seed {seed})...")
+    strata_sizes = defaultdict(lambda: [0, 0])  # stratum -> [conversations, text size]
+    sampled_info = {}  # key -> (stratum, text size)
+    total = 0
+
+    def sampled_conversations():
+        nonlocal total
+        for index, conversation in enumerate(data):
+            messages = _collect_messages(conversation, tokenizers)
+            if not messages:
+                continue
+            total += 1
+            size = sum(len(text.encode('utf-8', 'surrogatepass')) for *_, texts, _media in messages for text in texts)
+            if conversation.get('default_model_slug'):
+                model = tokenizers.resolve(conversation['default_model_slug'])[0]
+            else:
+                model = messages[0][3]
+            if conversation.get('create_time'):
+                month = datetime.fromtimestamp(conversation['create_time']).strftime('%Y-%m')
+            else:
+                month = next((message[2] for message in messages if message[2]), None)
+            stratum = (month, model)
+            strata_sizes[stratum][0] += 1
+            strata_sizes[stratum][1] += size
+            key = _conversation_key(conversation)
+            if key is None:
+                key = f"#{index}"
+                conversation = {**conversation, 'id': key}
+            # The first conversation of every stratum is always taken so each stratum can be extrapolated
+            if strata_sizes[stratum][0] == 1 or _is_sampled(key, fraction, seed):
+                sampled_info[key] = (stratum, size)
+                yield conversation
+
+    conversation_usage = {}
+    extract_token_usage(sampled_conversations(), tokenizers, conversation_usage=conversation_usage, **kwargs)
+
+    # Per-conversation usage and monthly costs of the sample, grouped by stratum
+    sample_usage = {key: UsageMatrix.from_dict(entry['usage']) for key, entry in conversation_usage.items()}
+    months = sorted({month for usage in sample_usage.values() for month in usage.months})
+    month_positions = {month: i for i, month in enumerate(months)}
+    strata = defaultdict(list)
+    for key, usage in sample_usage.items():
+        stratum, size = sampled_info[key]
+        monthly = np.zeros(len(months))
+        report = calculate_cost(usage, costs)
+        monthly[[month_positions[month] for month in report.usage.months]] = report.monthly_costs
+        strata[stratum].append((key, size, monthly))
+
+    # Pooled ratio and residual variance, used for strata with a single sampled conversation
+    all_sizes = np.array([size for members in strata.values() for _, size, _ in members], dtype=float)
+    all_costs = np.array([monthly for members in strata.values() for _, _, monthly in members]).reshape(-1, len(months))
+    pooled_ratio = all_costs.sum(axis=0) / all_sizes.sum() if all_sizes.sum() else np.zeros(len(months))
+    pooled_residuals = all_costs - np.outer(all_sizes, pooled_ratio)
+    pooled_variance = (pooled_residuals ** 2).sum(axis=0) / max(len(all_sizes) - 1, 1)
+
+    estimated_usage = UsageMatrix()
+    variances = np.zeros(len(months))
+    for stratum, (population, population_size) in strata_sizes.items():
+        members = strata.get(stratum, [])
+        sample_size = sum(size for _, size, _ in members)
+        if members and sample_size:
+            stratum_usage = UsageMatrix()
+            for key, _, _ in members:
+                stratum_usage.merge(sample_usage[key])
+            estimated_usage.merge(stratum_usage.scaled(population_size / sample_size))
+        if len(members) >= 2:
+            sizes = np.array([size for _, size, _ in members], dtype=float)
+            member_costs = np.array([monthly for _, _, monthly in members])
+            ratio = member_costs.sum(axis=0) / sizes.sum() if sizes.sum() else np.zeros(len(months))
+            residual_variance = ((member_costs - np.outer(sizes, ratio)) ** 2).sum(axis=0) / (len(members) - 1)
+        else:
+            residual_variance = pooled_variance
+        variances += population ** 2 * (1 - len(members) / population) / len(members) * residual_variance
+
+    cost_report = calculate_cost(estimated_usage, costs)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    margins = np.sqrt(variances)[[month_positions[month] for month in cost_report.usage.months]] * z
+    print(f"Tokenized {len(sample_usage)} of {total} conversations.")
+    return SampledCostReport(cost_report, margins, confidence, len(sample_usage), total)
+
+def print_sampled_costs(sampled_report):
+    """Print the estimated monthly costs with their confidence intervals."""
+    cost_report = sampled_report.cost_report
+    print(f"Estimated from {sampled_report.sampled_conversations} of {sampled_report.total_conversations} conversations "
+          f"({sampled_report.confidence:.0%} confidence intervals):")
+    print(f'{"Month":<10}{"Cost (USD)":>15}{"Low":>15}{"High":>15}')
+    for month, cost, margin in zip(cost_report.usage.months, cost_report.monthly_costs, sampled_report.monthly_margins):
+        print(f'{month:<10}{cost:>15,.2f}{max(cost - margin, 0.0):>15,.2f}{cost + margin:>15,.2f}')
+    print('-' * 55)
+
+# Seconds a fresh run of "--help" and of a report from saved usage may take, checked by "bench --startup"
+STARTUP_BUDGETS = {
+    "help": 1.0,
+    "cached report": 2.0
+}
+
+# File types plots can be rendered to without a display
+PLOT_FORMATS = ('.png', '.svg', '.pdf')
+
+def _pyplot(headless=False):
+    """Import pyplot on first use, with the non-interactive Agg backend when rendering to a file.
+
+    Importing matplotlib is slow, so it only happens when a plot is actually requested.
+    """
+    import matplotlib
+    if headless:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def check_plot_output(output):
+    """Raise a ValueError unless output is a file type plots can be saved as, and return it."""
+    if not output.lower().endswith(PLOT_FORMATS):
+        raise ValueError(f"Plots can only be saved as {', '.join(PLOT_FORMATS)} files, not {output}")
+    return output
+
+def _show_or_save(plt, fig, output=None):
+    """Show a figure in a window, or write it to output in the format given by its extension."""
+    if output is None:
+        plt.show()
+        return
+    fig.savefig(output)
+    plt.close(fig)
+    print(f"Saved plot to {output}.")
 
 def get_all_months(start_date, end_date):
     """Generate a list of all months between start_date and end_date."""
+    from dateutil.relativedelta import relativedelta
     months = []
     current_date = start_date
     while current_date <= end_date:
@@ -129,25 +1542,37 @@ def get_all_months(start_date, end_date):
         current_date += relativedelta(months=1)
     return months
 
-def plot_token_usage(monthly_model_usage_input, monthly_model_usage_output):
+def plot_token_usage(cost_report, subscription_tiers=None, output=None):
     print("Plotting token usage data...")
-    all_months = sorted(monthly_model_usage_input.keys())
-    all_models = sorted(set(model for month_data in monthly_model_usage_input.values() for model in month_data.keys()))
+    if output is not None:
+        check_plot_output(output)
+    plt = _pyplot(headless=output is not None)
+    usage = cost_report.usage
+    all_months = usage.months
+    all_models = usage.models
 
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 10))
     
     x = range(len(all_months))
     width = 0.35 / len(all_models)
     
-    cumulative_cost = 0.0
-    cumulative_costs = []
-    
     for i, model in enumerate(all_models):
-        input_data = [monthly_model_usage_input[month][model]['input'] for month in all_months]
-        output_data = [monthly_model_usage_output[month].get(model, {}).get('output', 0) for month in all_months]
+        input_data = usage.counts[:, i, TOKEN_TYPE_INDEX['input']]
+        cached_data = usage.counts[:, i, TOKEN_TYPE_INDEX['cached']]
+        output_data = usage.counts[:, i, TOKEN_TYPE_INDEX['output']]
+        media_data = usage.counts[:, i, [TOKEN_TYPE_INDEX[media_type]
+                                         for media_type in MEDIA_TYPES + OUTPUT_MEDIA_TYPES]].sum(axis=1)
         
         ax1.bar([j + i*width for j in x], input_data, width, label=f'{model} Input', alpha=0.7)
-        ax1.bar([j + i*width for j in x], output_data, width, bottom=input_data, label=f'{model} Output', alpha=0.7)
+        ax1.bar([j + i*width for j in x], cached_data, width, bottom=input_data, label=f'{model} Cached Input', alpha=0.7)
+        ax1.bar([j + i*width for j in x], output_data, width, bottom=input_data + cached_data, label=f'{model} Output', alpha=0.7)
+        reasoning_data = usage.counts[:, i, TOKEN_TYPE_INDEX['reasoning']]
+        if reasoning_data.any():
+            ax1.bar([j + i*width for j in x], reasoning_data, width, bottom=input_data + cached_data + output_data,
+                    label=f'{model} Reasoning', alpha=0.7)
+        if media_data.any():
+            ax1.bar([j + i*width for j in x], media_data, width,
+                    bottom=input_data + cached_data + output_data + reasoning_data, label=f'{model} Image/Audio', alpha=0.7)
 
     ax1.set_xlabel('Month')
     ax1.set_ylabel('Token Count')
@@ -156,75 +1581,450 @@ def plot_token_usage(monthly_model_usage_input, monthly_model_usage_output):
     ax1.set_xticklabels(all_months, rotation=45, ha='right')
 
     ax1_twin = ax1.twinx()
-    monthly_costs = [calculate_cost(monthly_model_usage_input[month], monthly_model_usage_output[month]) for month in all_months]
-    for cost in monthly_costs:
-        cumulative_cost += cost
-        cumulative_costs.append(cumulative_cost)
-
-    ax1_twin.plot(x, monthly_costs, color='red', label='Monthly Cost', marker='o', alpha=0.5)
+    ax1_twin.plot(x, cost_report.monthly_costs, color='red', label='Monthly Cost', marker='o', alpha=0.5)
     ax1_twin.set_ylabel('Cost (USD)', color='red')
     ax1_twin.tick_params(axis='y', labelcolor='red')
+    for name, fee in (subscription_tiers or {}).items():
+        ax1_twin.axhline(fee, linestyle='--', alpha=0.5, label=f'{name} Subscription')
 
-    ax2.plot(all_months, cumulative_costs, color='blue', label='Cumulative Cost', marker='o')
+    ax2.plot(all_months, cost_report.cumulative_costs, color='blue', label='Cumulative Cost', marker='o')
     ax2.set_xlabel('Month')
     ax2.set_ylabel('Cumulative Cost (USD)')
     ax2.set_title('Cumulative Monthly Cost')
     ax2.set_xticks(x)
     ax2.set_xticklabels(all_months, rotation=45, ha='right')
     ax2.legend()
-    ax1.legend(loc='upper left', bbox_to_anchor=(1.15, 1), borderaxespad=0., handles=ax1.containers + [ax1_twin.lines[0]])
+    ax1.legend(loc='upper left', bbox_to_anchor=(1.15, 1), borderaxespad=0., handles=ax1.containers + ax1_twin.lines)
 
     plt.subplots_adjust(right=0.85)
 
     plt.tight_layout()
-    plt.show()
+    _show_or_save(plt, fig, output)
     print("Plotting completed.")
 
 
-def print_token_usage(monthly_model_usage_input, monthly_model_usage_output, monthly_costs):
+def print_token_usage(cost_report):
     """Print the monthly and cumulative token usage with cost for each model."""
     print("Printing token usage data...")
-    all_months = sorted(monthly_model_usage_input.keys())
-    all_models = set(model for month_data in monthly_model_usage_input.values() for model in month_data.keys())
-
-    cumulative_cost = 0.0
-    print(f'{"Month":<10}{"Model":<15}{"Input Tokens":>15}{"Output Tokens":>15}{"Cost (USD)":>15}{"Cumulative Cost (USD)":>20}')
-    for month in all_months:
-        month_total_cost = 0.0
-        for model in all_models:
-            input_tokens = monthly_model_usage_input[month][model]['input']
-            output_tokens = monthly_model_usage_output[month].get(model, {}).get('output', 0)
-            cost = (input_tokens / 1_000_000 * COSTS[model]["input"]) + (output_tokens / 1_000_000 * COSTS[model]["output"])
-            month_total_cost += cost
-            print(f'{month:<10}{model:<15}{input_tokens:>15,}{output_tokens:>15,}{cost:>15,.2f}')
-        cumulative_cost += month_total_cost
-        print(f'{month:<10}{"TOTAL":<15}{"":<15}{"":<15}{month_total_cost:>15,.2f}{cumulative_cost:>20,.2f}')
-        print('-' * 90)
+    usage = cost_report.usage
+    input_counts = usage.counts[:, :, TOKEN_TYPE_INDEX['input']].tolist()
+    cached_counts = usage.counts[:, :, TOKEN_TYPE_INDEX['cached']].tolist()
+    output_counts = usage.counts[:, :, TOKEN_TYPE_INDEX['output']].tolist()
+    reasoning_counts = usage.counts[:, :, TOKEN_TYPE_INDEX['reasoning']].tolist()
+    # Image and audio tokens read and generated by the model are shown together
+    image_counts = usage.counts[:, :, [TOKEN_TYPE_INDEX['image'], TOKEN_TYPE_INDEX['image_output']]].sum(axis=2).tolist()
+    audio_counts = usage.counts[:, :, [TOKEN_TYPE_INDEX['audio'], TOKEN_TYPE_INDEX['audio_output']]].sum(axis=2).tolist()
+    model_costs = cost_report.model_costs.tolist()
+
+    print(f'{"Month":<10}{"Model":<15}{"Input Tokens":>15}{"Cached Tokens":>15}{"Output Tokens":>15}'
+          f'{"Reasoning":>15}{"Image Tokens":>15}{"Audio Tokens":>15}{"Cost (USD)":>15}{"Cumulative Cost (USD)":>22}')
+    for i, month in enumerate(usage.months):
+        for j, model in enumerate(usage.models):
+            print(f'{month:<10}{model:<15}{input_counts[i][j]:>15,}{cached_counts[i][j]:>15,}{output_counts[i][j]:>15,}'
+                  f'{reasoning_counts[i][j]:>15,}{image_counts[i][j]:>15,}{audio_counts[i][j]:>15,}{model_costs[i][j]:>15,.2f}')
+        month_total_cost = cost_report.monthly_costs[i]
+        cumulative_cost = cost_report.cumulative_costs[i]
+        print(f'{month:<10}{"TOTAL":<15}{"":<90}{month_total_cost:>15,.2f}{cumulative_cost:>22,.2f}')
+        print('-' * 152)
     print("Printing completed.")
 
+def _export_name(path):
+    """Name an export after its file, or after its directory for an extracted conversations.json."""
+    if os.path.basename(path) == 'conversations.json':
+        return os.path.basename(os.path.dirname(os.path.abspath(path)))
+    return os.path.splitext(os.path.basename(path))[0]
 
+def print_batch_report(batch, costs=COSTS):
+    """Print the tokens and cost of every export of a batch, the failed exports and the overall total."""
+    print("Printing batch report...")
+    context_types = [TOKEN_TYPE_INDEX[token_type] for token_type in ('input', 'cached', *MEDIA_TYPES)]
+    output_types = [TOKEN_TYPE_INDEX[token_type] for token_type in ('output', 'reasoning', *OUTPUT_MEDIA_TYPES)]
+
+    def print_row(name, usage):
+        cost_report = calculate_cost(usage, costs)
+        input_tokens = int(usage.counts[:, :, context_types].sum())
+        output_tokens = int(usage.counts[:, :, output_types].sum())
+        print(f'{name[:39]:<40}{input_tokens:>18,}{output_tokens:>18,}{float(cost_report.monthly_costs.sum()):>15,.2f}')
+
+    print(f'{"Export":<40}{"Input Tokens":>18}{"Output Tokens":>18}{"Cost (USD)":>15}')
+    for path, usage in batch.usages.items():
+        print_row(_export_name(path), usage)
+    print('-' * 91)
+    print_row("TOTAL", batch.merged)
+    for path, error in batch.failures.items():
+        print(f"Failed: {path} ({error})")
+    print("Printing completed.")
+
+def print_role_breakdown(cost_report):
+    """Print the context tokens sent for each month and model, broken down by message role."""
+    print("Printing context tokens by role...")
+    usage = cost_report.usage
+    role_counts = usage.counts[:, :, [TOKEN_TYPE_INDEX[role_type] for role_type in ROLE_TYPES]].tolist()
+
+    print(f'{"Month":<10}{"Model":<15}' + ''.join(f'{role.capitalize() + " Tokens":>18}' for role in CONTEXT_ROLES))
+    for i, month in enumerate(usage.months):
+        for j, model in enumerate(usage.models):
+            print(f'{month:<10}{model:<15}' + ''.join(f'{count:>18,}' for count in role_counts[i][j]))
+    totals = usage.counts[:, :, [TOKEN_TYPE_INDEX[role_type] for role_type in ROLE_TYPES]].sum(axis=(0, 1))
+    print('-' * (25 + 18 * len(CONTEXT_ROLES)))
+    print(f'{"TOTAL":<25}' + ''.join(f'{count:>18,}' for count in totals.tolist()))
+    print("Printing completed.")
+
+
+
+def _is_batch_input(path):
+    """Tell whether the input names several exports: a directory or a glob pattern."""
+    return os.path.isdir(path) or any(char in path for char in '*?[')
+
+def _compute_usage(args, price_book):
+    """Extract the usage selected by the command line options.
+
+    Returns the UsageMatrix with the SampledCostReport of the sample mode or the BatchUsage of
+    several exports, or None, and the ApproximateTokenCounter of the approx mode, or None.
+    """
+    if args.usage:
+        print(f"Reading usage from {args.usage}...")
+        with open(args.usage, 'r') as file:
+            data = json.load(file)
+        # Usage saved in the approx mode keeps the calibration it was estimated with, and that of
+        # several exports the usage of each of them
+        estimator = ApproximateTokenCounter.from_dict(data['estimator']) if data.get('estimator') else None
+        usage = UsageMatrix.from_dict(data)
+        if data.get('exports') is None:
+            return usage, None, estimator
+        usages = {path: UsageMatrix.from_dict(export_usage) for path, export_usage in data['exports'].items()}
+        return usage, BatchUsage(usages, usage, data.get('failures', {})), estimator
 
-def main():
-    json_file_path = 'chatgpt-api-cost-calculator/conversation/conversations_newer.json'
-    data = read_conversation_json(json_file_path)
-    
-    # Load tokenizers for all models once
     tokenizers = load_tokenizers()
-    
-    monthly_model_usage_input, monthly_model_usage_output = extract_token_usage(data, tokenizers)
-    
-    # Calculate monthly costs
+    batch = _is_batch_input(args.input)
+    paths = find_exports(args.input) if batch else [args.input]
+    if not paths:
+        raise SystemExit(f"No exports found in {args.input}")
+
+    if args.tokenizer_mode == 'sample':
+        if batch:
+            raise SystemExit("The sample mode reads a single export")
+        sampled_report = estimate_cost_sampled(iter_conversations(args.input), tokenizers, SAMPLE_FRACTION, SAMPLE_SEED,
+                                               costs=price_book, workers=args.workers)
+        return sampled_report.cost_report.usage, sampled_report, None
+
+    estimator = None
+    if args.tokenizer_mode == 'approx':
+        # Estimate token counts from text sizes, calibrated on a sample of the (first) export
+        estimator = load_or_calibrate_estimator(paths[0], tokenizers, recalibrate=args.recalibrate)
+    # Token counts of messages seen in previous runs are reused from the on-disk cache
+    cache = TokenCountCache(TOKEN_CACHE_PATH) if estimator is None else None
+    try:
+        if batch:
+            batch_usage = batch_token_usage(paths, args.workers, cache=cache, estimator=estimator)
+            return batch_usage.merged, batch_usage, estimator
+        # Only conversations that are new or changed since the previous run are re-extracted
+        data = read_conversation_json(args.input, stream=True)
+        state_path = APPROX_USAGE_STATE_PATH if estimator is not None else USAGE_STATE_PATH
+        return extract_token_usage_incremental(
+            data, tokenizers, state_path, workers=args.workers, cache=cache, estimator=estimator), None, estimator
+    finally:
+        if cache is not None:
+            cache.close()
+
+def _cost_report(args, price_book=None):
+    """Return the price book, usage, cost report, sample or batch details and estimator of the command line."""
+    if price_book is None:
+        price_book = load_price_book(args.prices or PRICE_BOOK_PATH)
+    usage, details, estimator = _compute_usage(args, price_book)
     print("Calculating monthly costs...")
-    monthly_costs = {
-            month: calculate_cost(monthly_model_usage_input[month], monthly_model_usage_output[month]) 
-            for month in monthly_model_usage_input.keys()
-        }
+    if isinstance(details, SampledCostReport):
+        cost_report = details.cost_report
+    else:
+        cost_report = calculate_cost(usage, price_book)
     print("Monthly cost calculation completed.")
-    
-    # Pass both arguments to print_token_usage
-    print_token_usage(monthly_model_usage_input, monthly_model_usage_output, monthly_costs)
-    plot_token_usage(monthly_model_usage_input, monthly_model_usage_output)
+    return price_book, usage, cost_report, details, estimator
+
+def _write_table(header, rows, output_format):
+    """Write rows as CSV, or as a list of JSON objects keyed by the header."""
+    if output_format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(header)
+        writer.writerows(rows)
+    else:
+        json.dump([dict(zip(header, row)) for row in rows], sys.stdout, indent=2)
+        print()
+
+def _cost_report_rows(cost_report):
+    usage = cost_report.usage
+    counts = usage.counts.tolist()
+    model_costs = cost_report.model_costs.tolist()
+    return [[month, model, *counts[i][j], round(model_costs[i][j], 6)]
+            for i, month in enumerate(usage.months) for j, model in enumerate(usage.models)]
+
+@contextmanager
+def _progress_output(args, quiet=False):
+    """Send progress messages to stderr when the output is JSON or CSV, or drop them if quiet."""
+    if quiet:
+        with redirect_stdout(io.StringIO()):
+            yield
+    elif args.format != 'text':
+        with redirect_stdout(sys.stderr):
+            yield
+    else:
+        yield
+
+def _with_error_bounds(header, rows, estimator):
+    """Add the error bounds of the estimated counts of each row's model (its second column) in the approx mode."""
+    if estimator is None:
+        return header, rows
+    bounds = estimator.model_error_bounds({row[1] for row in rows})
+    return [*header, 'error_part', 'error_total'], [[*row, *bounds[row[1]]] for row in rows]
+
+def _write_usage_table(header, usage_rows, usage, details, estimator, output_format):
+    """Write the rows usage_rows gives for the usage, with the error bounds of the approx mode.
+
+    For several exports, the rows of every export and of their total (as export "TOTAL") are written
+    with an export column, followed by one row with the error of every export that failed.
+    """
+    if not isinstance(details, BatchUsage):
+        _write_table(*_with_error_bounds(header, usage_rows(usage), estimator), output_format)
+        return
+    rows = [[name, *row, None]
+            for name, export_usage in [*details.usages.items(), ('TOTAL', usage)]
+            for row in _with_error_bounds(header, usage_rows(export_usage), estimator)[1]]
+    header = ['export', *_with_error_bounds(header, [], estimator)[0], 'error']
+    rows += [[path, *[None] * (len(header) - 2), error] for path, error in details.failures.items()]
+    _write_table(header, rows, output_format)
+
+def _usage_rows(usage):
+    usage = usage.sorted()
+    return [[month, model, *usage.counts[i, j].tolist()]
+            for i, month in enumerate(usage.months) for j, model in enumerate(usage.models)]
+
+def _analyze(args):
+    with _progress_output(args):
+        price_book = load_price_book(args.prices or PRICE_BOOK_PATH)
+        usage, details, estimator = _compute_usage(args, price_book)
+    usage = usage.sorted()
+    data = {**usage.to_dict(), 'estimator': estimator.to_dict() if estimator else None}
+    if isinstance(details, BatchUsage):
+        # The usage of every export is kept next to the total, for report --usage
+        data['exports'] = {path: export_usage.sorted().to_dict() for path, export_usage in details.usages.items()}
+        data['failures'] = details.failures
+    with open(args.save_usage, 'w') as file:
+        json.dump(data, file)
+    if args.format == 'text':
+        print(f"Saved the usage of {len(usage.months)} months and {len(usage.models)} models to {args.save_usage}.")
+        for token_type, total in zip(TOKEN_TYPES, usage.counts.sum(axis=(0, 1)).tolist()):
+            print(f'{token_type.replace("_", " ").capitalize() + " tokens":<25}{total:>18,}')
+        if isinstance(details, BatchUsage):
+            for path, error in details.failures.items():
+                print(f"Failed: {path} ({error})")
+        if estimator is not None:
+            estimator.print_error_bounds()
+    else:
+        _write_usage_table(['month', 'model', *TOKEN_TYPES], _usage_rows, usage, details, estimator, args.format)
+
+def _report(args):
+    with _progress_output(args):
+        price_book, usage, cost_report, details, estimator = _cost_report(args)
+    if args.format != 'text':
+        _write_usage_table(['month', 'model', *TOKEN_TYPES, 'cost'],
+                           lambda export_usage: _cost_report_rows(calculate_cost(export_usage, price_book)),
+                           usage, details, estimator, args.format)
+        return
+    if isinstance(details, BatchUsage):
+        print_batch_report(details, price_book)
+    print_token_usage(cost_report)
+    print_role_breakdown(cost_report)
+    if isinstance(details, SampledCostReport):
+        print_sampled_costs(details)
+    if estimator is not None:
+        estimator.print_error_bounds()
+    print_break_even(break_even_analysis(cost_report))
+
+def _plot(args):
+    price_book, usage, cost_report, details, estimator = _cost_report(args)
+    if estimator is not None:
+        estimator.print_error_bounds()
+    plot_token_usage(cost_report, SUBSCRIPTION_TIERS, args.output)
+
+def _compare(args):
+    with _progress_output(args):
+        price_book = load_price_book(args.prices or PRICE_BOOK_PATH)
+        # The current prices are always the first scenario. The others are checked before any extraction
+        scenarios = [PricingScenario('current', price_book, {})]
+        if os.path.exists(args.scenarios):
+            try:
+                scenarios += load_scenarios(args.scenarios, price_book)
+            except ValueError as e:
+                raise SystemExit(f"Invalid scenarios file {args.scenarios}: {e}")
+        price_book, usage, cost_report, details, estimator = _cost_report(args, price_book)
+        comparison = compare_scenarios(usage, scenarios)
+        break_even = break_even_analysis(cost_report)
+    if args.format == 'text':
+        print_scenario_comparison(comparison)
+        if estimator is not None:
+            estimator.print_error_bounds()
+        print_break_even(break_even)
+    else:
+        header = ['month', *comparison.names, *(f'{name} subscription' for name in break_even.tiers)]
+        rows = [[month, *comparison.monthly_costs[:, i].round(6).tolist(), *break_even.fees.tolist()]
+                for i, month in enumerate(comparison.months)]
+        if estimator is not None:
+            # A month's cost mixes models, so it gets the largest bounds of its models
+            bounds = list(estimator.model_error_bounds(usage.models).values())
+            largest = [max((bound[k] for bound in bounds if bound[k] is not None), default=None) for k in (0, 1)]
+            header += ['error_part', 'error_total']
+            rows = [[*row, *largest] for row in rows]
+        _write_table(header, rows, args.format)
+    if args.plot or args.output:
+        with _progress_output(args):
+            plot_scenario_comparison(comparison, args.output)
+
+def _bench_startup(args):
+    """Time fresh runs of --help and of a report from saved usage, failing if over STARTUP_BUDGETS."""
+    script = os.path.abspath(__file__)
+    with tempfile.TemporaryDirectory() as directory:
+        usage_path = args.usage
+        if usage_path is None:
+            # A year of usage of every priced model is enough to exercise the report
+            usage = UsageMatrix()
+            for month in range(1, 13):
+                for model in COSTS:
+                    for token_type in TOKEN_TYPES:
+                        usage.add(f"2024-{month:02d}", model, token_type, 1_000_000)
+            usage_path = os.path.join(directory, 'usage.json')
+            with open(usage_path, 'w') as file:
+                json.dump(usage.to_dict(), file)
+        commands = {
+            'help': [sys.executable, script, '--help'],
+            'cached report': [sys.executable, script, 'report', '--usage', usage_path,
+                              *(['--prices', args.prices] if args.prices else [])],
+        }
+        timings = {}
+        for name, command in commands.items():
+            timings[name] = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+                timings[name].append(time.perf_counter() - start)
+
+    over_budget = [name for name, runs in timings.items() if min(runs) > STARTUP_BUDGETS[name]]
+    if args.format == 'text':
+        print(f"Startup times over {args.repeat} runs:")
+        print(f'{"Run":<15}{"Best (s)":>12}{"Mean (s)":>12}{"Budget (s)":>12}')
+        for name, runs in timings.items():
+            print(f'{name:<15}{min(runs):>12.3f}{sum(runs) / len(runs):>12.3f}{STARTUP_BUDGETS[name]:>12.3f}'
+                  + ('  OVER BUDGET' if name in over_budget else ''))
+    else:
+        rows = [[name, round(min(runs), 6), round(sum(runs) / len(runs), 6), STARTUP_BUDGETS[name]]
+                for name, runs in timings.items()]
+        _write_table(['run', 'best_seconds', 'mean_seconds', 'budget_seconds'], rows, args.format)
+    if over_budget:
+        raise SystemExit(f"Startup time over budget: {', '.join(over_budget)}")
+
+def _bench(args):
+    """Time each stage on the input, without the token cache or the incremental state."""
+    if args.startup:
+        _bench_startup(args)
+        return
+    timings = defaultdict(list)
+    with _progress_output(args, quiet=True):
+        price_book = load_price_book(args.prices or PRICE_BOOK_PATH)
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            tokenizers = load_tokenizers()
+            conversations = sum(1 for _ in iter_conversations(args.input))
+            timings['parse'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            estimator = None
+            if args.tokenizer_mode == 'approx':
+                with closing(iter_conversations(args.input)) as calibration_data:
+                    estimator = calibrate_estimator(calibration_data, tokenizers)
+            if args.tokenizer_mode == 'sample':
+                usage = estimate_cost_sampled(iter_conversations(args.input), tokenizers, SAMPLE_FRACTION, SAMPLE_SEED,
+                                              costs=price_book, workers=args.workers).cost_report.usage
+            else:
+                usage = extract_token_usage(iter_conversations(args.input), tokenizers, workers=args.workers,
+                                            estimator=estimator)
+            timings['extract'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            calculate_cost(usage, price_book)
+            timings['cost'].append(time.perf_counter() - start)
+
+    if args.format == 'text':
+        print(f"Benchmarked {conversations} conversations ({args.tokenizer_mode} mode, {args.workers} workers, "
+              f"{args.repeat} runs):")
+        print(f'{"Stage":<10}{"Best (s)":>12}{"Mean (s)":>12}')
+        for stage, stage_timings in timings.items():
+            print(f'{stage:<10}{min(stage_timings):>12.3f}{sum(stage_timings) / len(stage_timings):>12.3f}')
+    else:
+        rows = [[stage, round(min(stage_timings), 6), round(sum(stage_timings) / len(stage_timings), 6)]
+                for stage, stage_timings in timings.items()]
+        _write_table(['stage', 'best_seconds', 'mean_seconds'], rows, args.format)
+
+def _plot_output_argument(output):
+    try:
+        return check_plot_output(output)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from e
+
+def build_parser():
+    """Build the command line parser and its subcommands."""
+    parser = argparse.ArgumentParser(
+        description="Estimate what your ChatGPT usage would have cost on the API, and compare it with subscriptions.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    inputs = argparse.ArgumentParser(add_help=False)
+    inputs.add_argument('input', nargs='?', default=DEFAULT_EXPORT_PATH,
+                        help=f"export zip, conversations.json, or a directory or glob of exports "
+                             f"(default: {DEFAULT_EXPORT_PATH})")
+    inputs.add_argument('--usage', help="read the usage saved by analyze instead of extracting it")
+    inputs.add_argument('--workers', type=int, default=EXTRACTION_WORKERS,
+                        help="worker processes, or exports processed at the same time for several exports")
+    inputs.add_argument('--tokenizer-mode', choices=('exact', 'approx', 'sample'), default=TOKENIZER_MODE,
+                        help="count every token exactly, estimate counts from text sizes, or extrapolate from a sample")
+    inputs.add_argument('--recalibrate', action='store_true',
+                        help=f"fit the approx mode's estimator again instead of reusing {ESTIMATOR_PATH}")
+    inputs.add_argument('--prices', help=f"price book file in JSON or TOML (default: {os.path.basename(PRICE_BOOK_PATH)} "
+                                         f"next to main.py if present, else the static COSTS)")
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument('--format', choices=('text', 'json', 'csv'), default='text', help="output format")
+
+    analyze = subparsers.add_parser('analyze', parents=[inputs, output],
+                                    help="extract the token usage and save it for the other commands")
+    analyze.add_argument('--save-usage', default=USAGE_PATH, help=f"usage file to write (default: {USAGE_PATH})")
+    analyze.set_defaults(handler=_analyze)
+    subparsers.add_parser('report', parents=[inputs, output],
+                          help="print the monthly token usage and cost").set_defaults(handler=_report)
+    plot = subparsers.add_parser('plot', parents=[inputs], help="plot the monthly token usage and cost")
+    plot.add_argument('--output', type=_plot_output_argument, help="write the plot to a PNG, SVG or PDF file instead of showing it")
+    plot.set_defaults(handler=_plot)
+    compare = subparsers.add_parser('compare', parents=[inputs, output],
+                                    help="compare pricing scenarios and subscriptions")
+    compare.add_argument('--scenarios', default=SCENARIOS_PATH,
+                         help=f"pricing scenarios file (default: {os.path.basename(SCENARIOS_PATH)} next to main.py)")
+    compare.add_argument('--plot', action='store_true', help="also plot the cumulative cost of each scenario")
+    compare.add_argument('--output', type=_plot_output_argument, help="write the scenario plot to a PNG, SVG or PDF file instead of showing it")
+    compare.set_defaults(handler=_compare)
+    bench = subparsers.add_parser('bench', parents=[inputs, output], help="time the parsing, extraction and costing")
+    bench.add_argument('--repeat', type=int, default=3, help="number of timed runs")
+    bench.add_argument('--startup', action='store_true',
+                       help="time --help and a report from saved usage instead, failing if over STARTUP_BUDGETS")
+    bench.set_defaults(handler=_bench)
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    # Check the paths given before any work is done, so a typo does not silently change the results
+    if args.prices is not None and not os.path.isfile(args.prices):
+        parser.error(f"price book {args.prices} not found")
+    if args.usage is not None and not os.path.isfile(args.usage):
+        parser.error(f"usage file {args.usage} not found")
+    needs_input = args.usage is None and not getattr(args, 'startup', False)
+    if needs_input and not _is_batch_input(args.input) and not os.path.isfile(args.input):
+        parser.error(f"export {args.input} not found")
+    args.handler(args)
 
 if __name__ == '__main__':
     main()
- 
\ No newline at end of file
@@ -0,0 +1,404 @@
+import io
+import json
+import zipfile
+
+import pytest
+
+import main
+from main import (COSTS, BatchUsage, MEDIA_TYPES, OUTPUT_MEDIA_TYPES, PRICE_BOOK_PATH, TOKEN_TYPE_INDEX, ApproximateTokenCounter, PriceBook, TokenCountCache, TokenizerRegistry,
+                  UsageMatrix, _bill_conversation_tree, _iter_json_array, cached_prompt_tokens, calculate_cost,
+                  _split_parts, _usage_rows, _write_usage_table, compare_scenarios, count_tokens_cached, extract_token_usage, extract_token_usage_incremental,
+                  find_exports, image_tokens, iter_conversations, load_scenarios, load_tokenizers, price_matrix, read_conversation_json)
+
+MONTH = '2024-06'
+NO_MEDIA = (0, 0)
+# 2024-06-10, far enough from the month's ends for any local time zone
+START_TIME = 1718000000
+
+
+class WordTokenizer:
+    """Stand-in for a tiktoken encoding with one token per word, counting the texts it encodes."""
+    name = 'words'
+
+    def __init__(self):
+        self.encoded = 0
+
+    def encode_ordinary(self, text):
+        self.encoded += 1
+        return text.split()
+
+    def encode_ordinary_batch(self, texts, num_threads=1):
+        return [self.encode_ordinary(text) for text in texts]
+
+
+class WordTokenizers(TokenizerRegistry):
+    """Registry resolving models as usual but counting every encoding with a WordTokenizer."""
+
+    def __init__(self):
+        super().__init__()
+        self.tokenizer = WordTokenizer()
+
+    def get(self, encoding_name):
+        return self.tokenizer
+
+
+def conversation(conversation_id, turns, update_time=1, model_slug='gpt-4o'):
+    """Build an exported conversation from (role, text) turns, each one replying to the previous one."""
+    mapping = {}
+    parent_id = None
+    for i, (role, text) in enumerate(turns):
+        node_id = f'{conversation_id}-{i}'
+        mapping[node_id] = {'id': node_id, 'parent': parent_id, 'children': [], 'message': {
+            'author': {'role': role}, 'create_time': START_TIME + 1000 * i, 'metadata': {'model_slug': model_slug},
+            'content': {'content_type': 'text', 'parts': [text]}}}
+        if parent_id is not None:
+            mapping[parent_id]['children'].append(node_id)
+        parent_id = node_id
+    return {'conversation_id': conversation_id, 'update_time': update_time, 'mapping': mapping}
+
+
+def conversations(count):
+    """Build count linear conversations of two turns with different lengths."""
+    return [conversation(f'c{i}', [('system', 'Be brief.'), ('user', 'word ' * (i + 1)),
+                                   ('assistant', 'answer ' * (2 * i + 1)), ('user', 'thanks'), ('assistant', 'ok')])
+            for i in range(count)]
+
+
+def bill(nodes, model):
+    """Bill a conversation given as (node_id, parent_id, role, tokens, create_time) tuples."""
+    mapping = {node_id: {'parent': parent_id, 'children': []} for node_id, parent_id, *_ in nodes}
+    for node_id, parent_id, *_ in nodes:
+        if parent_id in mapping:
+            mapping[parent_id]['children'].append(node_id)
+    message_tokens = {node_id: (create_time, MONTH, model, role, tokens, NO_MEDIA)
+                      for node_id, _, role, tokens, create_time in nodes}
+    usage = UsageMatrix()
+    _bill_conversation_tree(mapping, message_tokens, usage)
+    return {token_type: usage.get(MONTH, model, token_type)
+            for token_type in ('input', 'cached', 'output', 'reasoning', 'system_context', 'user_context')}
+
+
+def test_branches_are_billed_with_their_own_context():
+    usage = bill([
+        ('system', None, 'system', 10, 0),
+        ('question', 'system', 'user', 100, 1000),
+        ('answer', 'question', 'assistant', 50, 2000),
+        ('regenerated', 'question', 'assistant', 70, 3000),
+        ('follow-up', 'answer', 'user', 20, 4000),
+        ('second answer', 'follow-up', 'assistant', 30, 5000),
+    ], 'gpt-4o')
+    assert usage['input'] == 110 + 110 + 180
+    assert usage['output'] == 50 + 70 + 30
+    assert usage['system_context'] == 30
+    assert usage['user_context'] == 100 + 100 + 120
+
+
+def test_context_is_truncated_to_the_window():
+    usage = bill([
+        ('question', None, 'user', 5000, 0),
+        ('answer', 'question', 'assistant', 3000, 1000),
+        ('follow-up', 'answer', 'user', 4000, 2000),
+        ('second answer', 'follow-up', 'assistant', 10, 3000),
+    ], 'gpt-4')
+    # The second prompt (12,000 tokens) drops the first question to fit the 8,192 token window
+    assert usage['input'] == 5000 + 7000
+
+
+def test_latest_message_is_kept_even_beyond_the_window():
+    usage = bill([
+        ('question', None, 'user', 10000, 0),
+        ('answer', 'question', 'assistant', 10, 1000),
+    ], 'gpt-4')
+    assert usage['input'] == 8192
+
+
+def test_prompt_extending_a_recent_call_is_cached():
+    nodes = [
+        ('question', None, 'user', 2000, 0),
+        ('answer', 'question', 'assistant', 100, 10),
+        ('follow-up', 'answer', 'user', 50, 20),
+        ('second answer', 'follow-up', 'assistant', 10, 30),
+    ]
+    usage = bill(nodes, 'gpt-4o')
+    assert usage['cached'] == 1920
+    assert usage['input'] == 2000 + 2150 - 1920
+
+    # Past the cache lifetime the whole prompt is billed again
+    nodes[-1] = ('second answer', 'follow-up', 'assistant', 10, 1000)
+    usage = bill(nodes, 'gpt-4o')
+    assert usage['cached'] == 0
+    assert usage['input'] == 2000 + 2150
+
+
+def test_cached_prompt_tokens():
+    assert cached_prompt_tokens(1000, 5000) == 0
+    assert cached_prompt_tokens(1500, 1400) == 1280
+    assert cached_prompt_tokens(4096, 5000) == 4096
+
+
+@pytest.mark.parametrize('recorded, expected', [(0, 400), (50, 400), (500, 500)])
+def test_reasoning_is_at_least_the_recorded_thoughts(recorded, expected):
+    usage = bill([
+        ('question', None, 'user', 100, 0),
+        ('thoughts', 'question', 'reasoning', recorded, 10),
+        ('answer', 'thoughts', 'assistant', 100, 20),
+        ('follow-up', 'answer', 'user', 10, 1000),
+        ('second answer', 'follow-up', 'assistant', 25, 2000),
+    ], 'o1')
+    assert usage['reasoning'] == expected + 100
+    assert usage['output'] == 125
+    # Thoughts are not part of the context of later turns
+    assert usage['input'] == 100 + 210
+
+
+def test_iter_json_array_reads_elements_across_chunks():
+    data = '﻿ [{"id": "a", "mapping": {}}, {"id": "b", "title": "x, y"} ,{}] '
+    assert list(_iter_json_array(io.StringIO(data), chunk_size=3)) == [
+        {'id': 'a', 'mapping': {}}, {'id': 'b', 'title': 'x, y'}, {}]
+    assert list(_iter_json_array(io.StringIO('[]'), chunk_size=3)) == []
+
+
+@pytest.mark.parametrize('data', ['[{"id": "a"}, {"id"', '[{"id": "a"}', '{"id": "a"}'])
+def test_iter_json_array_rejects_invalid_data(data):
+    with pytest.raises(ValueError):
+        list(_iter_json_array(io.StringIO(data), chunk_size=4))
+
+
+def test_parallel_extraction_matches_serial():
+    # The estimator counts tokens without loading any encoding, in the workers too
+    data = conversations(20)
+    tokenizers = load_tokenizers()
+    estimator = ApproximateTokenCounter()
+    serial = extract_token_usage(data, tokenizers, estimator=estimator)
+    parallel = extract_token_usage(iter(data), tokenizers, workers=2, shard_size=3, estimator=estimator)
+    assert serial.get(MONTH, 'gpt-4o', 'input') > 0
+    assert parallel.to_dict() == serial.to_dict()
+
+
+def test_token_cache_reuses_counts(tmp_path):
+    tokenizer = WordTokenizer()
+    cache = TokenCountCache(str(tmp_path / 'cache.sqlite'))
+    assert count_tokens_cached(['a b', 'c', 'a b'], tokenizer, cache) == [2, 1, 2]
+    assert tokenizer.encoded == 3
+    assert count_tokens_cached(['c', 'a b', 'd e f'], tokenizer, cache) == [1, 2, 3]
+    assert tokenizer.encoded == 4
+    assert (cache.hits, cache.misses) == (2, 4)
+    cache.close()
+
+    # The counts outlive the connection
+    cache = TokenCountCache(str(tmp_path / 'cache.sqlite'))
+    assert cache.lookup('words', ['d e f'])[1] == [3]
+    assert cache.lookup('other', ['d e f'])[1] == [None]
+    cache.close()
+
+
+def test_token_cache_evicts_least_recently_used(tmp_path):
+    tokenizer = WordTokenizer()
+    cache = TokenCountCache(str(tmp_path / 'cache.sqlite'), max_entries=2)
+    count_tokens_cached(['a', 'b'], tokenizer, cache)
+    count_tokens_cached(['a'], tokenizer, cache)
+    count_tokens_cached(['c'], tokenizer, cache)
+    assert cache.lookup('words', ['a', 'b', 'c'])[1] == [1, None, 1]
+    cache.close()
+
+
+def test_incremental_extraction_reuses_unchanged_conversations(tmp_path):
+    state_path = str(tmp_path / 'state.json')
+    tokenizers = WordTokenizers()
+    data = conversations(3)
+    first = extract_token_usage_incremental(data, tokenizers, state_path)
+    encoded = tokenizers.tokenizer.encoded
+    assert extract_token_usage_incremental(data, tokenizers, state_path).to_dict() == first.to_dict()
+    assert tokenizers.tokenizer.encoded == encoded
+
+    # Only the updated conversation is extracted again
+    data[1] = conversation('c1', [('user', 'a new question'), ('assistant', 'and its answer')], update_time=2)
+    updated = extract_token_usage_incremental(data, tokenizers, state_path)
+    assert tokenizers.tokenizer.encoded == encoded + 2
+    expected = extract_token_usage(data, WordTokenizers())
+    assert updated.to_dict() == expected.to_dict()
+
+
+def test_incremental_state_is_dropped_when_settings_change(tmp_path, monkeypatch):
+    state_path = str(tmp_path / 'state.json')
+    tokenizers = WordTokenizers()
+    data = conversations(3)
+    extract_token_usage_incremental(data, tokenizers, state_path)
+    encoded = tokenizers.tokenizer.encoded
+    monkeypatch.setattr(main, 'PROMPT_CACHE_TTL', 60)
+    extract_token_usage_incremental(data, tokenizers, state_path)
+    assert tokenizers.tokenizer.encoded == 2 * encoded
+
+
+def test_usage_matrix_grows_and_merges():
+    usage = UsageMatrix()
+    for month in range(1, 11):
+        for model in ('gpt-4', 'gpt-4o', 'o1', 'o3', 'o4-mini'):
+            usage.add(f'2024-{month:02d}', model, 'input', month)
+    assert usage.counts.shape == (10, 5, len(main.TOKEN_TYPES))
+    assert usage.get('2024-07', 'o3', 'input') == 7
+    # Reading unknown months or models returns 0 without adding them
+    assert usage.get('2023-01', 'o3', 'input') == 0
+    assert usage.get('2024-07', 'gpt-3.5-turbo', 'input') == 0
+    assert len(usage.months) == 10 and len(usage.models) == 5
+
+    other = UsageMatrix()
+    other.add('2025-01', 'gpt-3.5-turbo', 'output', 5)
+    other.add('2024-07', 'o3', 'input', 3)
+    usage.merge(other)
+    assert usage.get('2024-07', 'o3', 'input') == 10
+    assert usage.get('2025-01', 'gpt-3.5-turbo', 'output') == 5
+    assert usage.sorted().models == ['gpt-3.5-turbo', 'gpt-4', 'gpt-4o', 'o1', 'o3', 'o4-mini']
+
+
+def test_usage_matrix_round_trips_through_dict():
+    usage = UsageMatrix()
+    usage.add('2024-02', 'o1', 'reasoning', 7)
+    usage.add('2024-01', 'gpt-4o', 'image', 3)
+    assert UsageMatrix.from_dict(usage.to_dict()).to_dict() == usage.to_dict()
+    # Token types are matched by name, so files with fewer or reordered types still load
+    data = {'months': ['2024-01'], 'models': ['gpt-4o'], 'token_types': ['output', 'input'], 'counts': [[[2, 1]]]}
+    loaded = UsageMatrix.from_dict(data)
+    assert (loaded.get('2024-01', 'gpt-4o', 'input'), loaded.get('2024-01', 'gpt-4o', 'output')) == (1, 2)
+    assert UsageMatrix.from_dict({'months': [], 'models': [], 'token_types': [], 'counts': []}).months == []
+
+
+def test_estimator_error_bounds_follow_the_model_encoding():
+    estimator = ApproximateTokenCounter({'o200k_base': 4.5}, {'o200k_base': {'part': 0.2, 'total': 0.01, 'sample_size': 10}})
+    assert ApproximateTokenCounter.from_dict(estimator.to_dict()).to_dict() == estimator.to_dict()
+    assert estimator.model_error_bounds(['o1', 'gpt-4-turbo']) == {'o1': [0.2, 0.01], 'gpt-4-turbo': [None, None]}
+
+
+def test_price_book_uses_the_entry_in_effect_each_month(tmp_path):
+    path = tmp_path / 'prices.toml'
+    path.write_text('''
+[[models.o3]]
+effective_from = "2025-06-10"
+input = 2.0
+output = 8.0
+
+[[models.o3]]
+effective_from = "2025-04-16"
+input = 10.0
+output = 40.0
+''')
+    book = PriceBook.load(str(path))
+    prices = book.price_tensor(['2025-01', '2025-05', '2025-06', '2025-07'], ['o3', 'gpt-4'])
+    # Months before the first entry use it, and a change applies from the next month on
+    assert prices[:, 0, TOKEN_TYPE_INDEX['input']].tolist() == [10.0, 10.0, 10.0, 2.0]
+    assert prices[:, 0, TOKEN_TYPE_INDEX['reasoning']].tolist() == [40.0, 40.0, 40.0, 8.0]
+    # Models missing from the book fall back to COSTS
+    assert prices[:, 1, TOKEN_TYPE_INDEX['output']].tolist() == [COSTS['gpt-4']['output']] * 4
+
+    usage = UsageMatrix()
+    usage.add('2025-05', 'o3', 'output', 1_000_000)
+    usage.add('2025-07', 'o3', 'output', 1_000_000)
+    assert calculate_cost(usage, book).monthly_costs.tolist() == [40.0, 8.0]
+
+
+def test_scenarios_lay_their_prices_over_the_base_prices(tmp_path):
+    (tmp_path / 'cheap.json').write_text(json.dumps({'models': {'gpt-4o': [{'effective_from': '2024-01-01', 'input': 1.0}]}}))
+    (tmp_path / 'scenarios.json').write_text(json.dumps({'scenarios': [
+        {'name': 'same'},
+        {'name': 'cheap gpt-4o', 'prices': 'cheap.json'},
+        {'name': 'all vendor', 'prices': {'vendor': {'input': 0.5}}, 'model_map': {'gpt-4o': 'vendor'}},
+        {'name': 'all o3', 'model_map': {'gpt-4o': 'o3'}},
+    ]}))
+    base_prices = {'gpt-4o': {'input': 2.0}, 'o1': {'input': 10.0}, 'o3': {'input': 4.0}}
+    scenarios = load_scenarios(str(tmp_path / 'scenarios.json'), base_prices)
+    usage = UsageMatrix()
+    usage.add('2024-06', 'gpt-4o', 'input', 1_000_000)
+    usage.add('2024-06', 'o1', 'input', 1_000_000)
+    # Models a scenario does not price keep their base prices
+    assert compare_scenarios(usage, scenarios).total_costs.tolist() == [12.0, 11.0, 10.5, 14.0]
+
+
+def test_scenarios_must_price_the_models_they_map_to(tmp_path):
+    (tmp_path / 'scenarios.json').write_text(json.dumps({'scenarios': [
+        {'name': 'other vendor', 'model_map': {'gpt-4o': 'claude-3'}}]}))
+    with pytest.raises(ValueError, match='other vendor.*claude-3'):
+        load_scenarios(str(tmp_path / 'scenarios.json'))
+
+
+@pytest.mark.parametrize('width, height, tokens', [
+    (512, 512, 85 + 170), (1024, 1024, 85 + 4 * 170), (2048, 4096, 85 + 6 * 170), (100, 3000, 85 + 4 * 170), (None, 800, 85)])
+def test_image_tokens_count_tiles_after_scaling(width, height, tokens):
+    assert image_tokens(width, height) == tokens
+
+
+def test_split_parts_counts_media_from_metadata():
+    parts = ['a caption', {'content_type': 'image_asset_pointer', 'width': 1024, 'height': 1024},
+             {'content_type': 'audio_asset_pointer', 'metadata': {'start': 1.0, 'end': 3.55}},
+             {'content_type': 'audio_transcription', 'text': 'spoken words'}, {'content_type': 'unknown', 'x': 1}]
+    texts, media = _split_parts(parts)
+    assert texts == ['a caption', '{"content_type": "unknown", "x": 1}']
+    assert media == (765, 26)
+
+
+def test_price_book_prices_media_like_costs():
+    # A book entry replaces a model's COSTS prices entirely, so it must repeat their media prices
+    book = PriceBook.load(PRICE_BOOK_PATH)
+    models = list(COSTS)
+    latest_prices = book.price_tensor(['2099-01'], models)[0]
+    static_prices = price_matrix(models)
+    for k, model in enumerate(models):
+        latest_entry = book.entries[model][-1]
+        for token_type in MEDIA_TYPES + OUTPUT_MEDIA_TYPES:
+            if token_type in COSTS[model]:
+                assert token_type in latest_entry, (model, token_type)
+            if all(latest_entry[price] == COSTS[model][price] for price in ('input', 'output')):
+                assert latest_prices[k, TOKEN_TYPE_INDEX[token_type]] == static_prices[k, TOKEN_TYPE_INDEX[token_type]], \
+                    (model, token_type)
+
+
+@pytest.mark.parametrize('slug, model', [
+    ('o3-2025-04-16', 'o3'), ('o3-pro-2025-06-10', 'o3-pro'), ('o3-mini-high', 'o3-mini'), ('o1-preview', 'o1'),
+    ('gpt-4o-mini-2024-07-18', 'gpt-4o-mini'), ('gpt-4-gizmo', 'gpt-4-turbo'), ('o4-pro', 'gpt-4o'),
+    ('gpt-4.5', 'gpt-4o'), (None, 'gpt-4o')])
+def test_tokenizer_registry_resolves_model_slugs(slug, model):
+    assert load_tokenizers().resolve(slug)[0] == model
+
+
+def test_conversations_are_read_from_the_export_zip(tmp_path):
+    data = conversations(3)
+    path = str(tmp_path / 'export.zip')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('export/chat.html', '<html></html>')
+        archive.writestr('export/attachments/conversations.json', '[]')
+        archive.writestr('export/conversations.json', json.dumps(data))
+    assert list(iter_conversations(path, chunk_size=64)) == data
+    assert read_conversation_json(path) == data
+
+
+def test_export_zip_without_conversations_is_rejected(tmp_path):
+    path = str(tmp_path / 'export.zip')
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('chat.html', '<html></html>')
+    with pytest.raises(ValueError, match='No conversations.json'):
+        list(iter_conversations(path))
+
+
+def test_find_exports_skips_other_json_files(tmp_path):
+    for name in ('alice.zip', 'conversations.json', 'bob/conversations.json', 'bob/user.json', 'usage.json',
+                 'prices.json', 'token_estimator.json', 'usage_state.json'):
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_text('[]')
+    assert find_exports(str(tmp_path)) == sorted(
+        str(tmp_path / name) for name in ('alice.zip', 'conversations.json', 'bob/conversations.json'))
+    assert find_exports(str(tmp_path / '*')) == sorted(
+        str(tmp_path / name) for name in ('alice.zip', 'bob/conversations.json', 'conversations.json', 'prices.json',
+                                          'token_estimator.json', 'usage.json', 'usage_state.json'))
+
+
+def test_batch_tables_list_every_export_and_failure(capsys):
+    alice, bob = UsageMatrix(), UsageMatrix()
+    alice.add(MONTH, 'gpt-4o', 'input', 1)
+    bob.add(MONTH, 'gpt-4o', 'input', 2)
+    merged = UsageMatrix()
+    merged.merge(alice)
+    merged.merge(bob)
+    batch = BatchUsage({'alice.zip': alice, 'bob.zip': bob}, merged, {'carol.zip': 'BadZipFile: bad'})
+    _write_usage_table(['month', 'model', *main.TOKEN_TYPES], _usage_rows, merged, batch, None, 'json')
+    rows = json.loads(capsys.readouterr().out)
+    assert [(row['export'], row['input'], row['error']) for row in rows] == [
+        ('alice.zip', 1, None), ('bob.zip', 2, None), ('TOTAL', 3, None), ('carol.zip', None, 'BadZipFile: bad')]